@@ -8,6 +8,7 @@ NODE_CLASS_MAPPINGS = {
     "MUJinjaRender": j.MUJinjaRender,
     "MUSimpleWildcard": w.MUSimpleWildcard,
     "MUForceCacheClear": m.MUForceCacheClear,
+    "MUMemoryDiagnostics": m.MUMemoryDiagnostics,
     "MUReplaceModelWeights": r.MUReplaceModelWeights,
     "MUConditioningCutoff": c.MUConditioningCutoff,
     "MURemoveControlNet": c.MURemoveControlNet,
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Read when the modules are imported, so that tests don't write snapshots and indexes into the repository's cache
+os.environ.setdefault("MU_WILDCARD_CACHE_DIR", tempfile.mkdtemp(prefix="mu-utils-tests-"))
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from utils import comfy_stubs  # noqa: E402
+
+comfy_stubs.install()
@@ -0,0 +1,80 @@
+"""Prompts for comparing parsers and engines, and a generator of random programs using variables, functions,
+definitions inside function bodies, quoted strings and brackets"""
+
+import random
+
+PROMPTS = [
+    "",
+    "plain text, with commas (and brackets) [and more] <lora:x:1>",
+    "$x = red\na $x cat",
+    "$x=1 $y = $x$x\n$y",
+    "$f($a, $b=2) = { a $a b $b }\n$f(1) and $f(3, $b=5), $f($b=4, $a=0)",
+    '$f($a) = { [$a] }\n$f("quoted, text") $f("with \\"escapes\\"")',
+    "$f($a) = {\n  $g($b) = { <$b> }\n  $g($a) $g(x)\n}\n$f(y)",
+    "$x = (nested (brackets)) {braces}\n$x, $x",
+    "${x}y $x=5\n${x}y",
+    "a, b; c\n\nd",
+    "$x = a\n\nb $x",
+    "$x=\n\nz",
+    "$x = a\r\n\r\nb $x\r\n",
+    "$f($a) = { $a }\n\n\n$f(x)\n\n$y = b\n\n\n$y $f($y)",
+    "$empty =\n[$empty]",
+    "$greeting = hello\n$who = world\n$greeting $who\n$who = there\n$greeting $who",
+    "$f($a=1, $b=$a) = { $a $b }\n$f() $f(2) $f(2, 3)",
+    "$comment(anything at all) done",
+    "$x = $seed\n$x, seed $seed",
+    "$f($x) = { $x $x }\n$f($f(a))",
+    "$(1+2) and $('a' * 3)",
+    "unterminated $f(",
+    "$undefined here",
+    "$f($a) = { $a }\n$f(1, 2)",
+]
+
+VARS = "abcde"
+FUNCTIONS = "fgh"
+
+
+def atom(r, params, depth):
+    c = r.random()
+    if c < 0.3:
+        return r.choice(["x", "y", "red", "blue", "1", '"q, t"'])
+    if c < 0.55:
+        return "$" + r.choice(VARS + "".join(params))
+    if c < 0.85 and depth < 3:
+        return call(r, params, depth + 1)
+    if c < 0.9:
+        return "$seed"
+    return "(" + atom(r, params, depth + 1) + ")"
+
+
+def expression(r, params, depth=0):
+    return " ".join(atom(r, params, depth) for _ in range(r.randint(1, 3)))
+
+
+def call(r, params, depth):
+    args = [expression(r, params, depth).replace(",", "") for _ in range(r.randint(0, 2))]
+    return f"${r.choice(FUNCTIONS)}({', '.join(args)})"
+
+
+def line(r, definitions=False):
+    c = r.random() * (0.55 if definitions else 1)
+    if c < 0.3:
+        return f"${r.choice(VARS)} = {expression(r, '')}"
+    if c < 0.55:
+        params = r.sample("pqr", r.randint(0, 2))
+        plist = ", ".join(f"${x}=d{x}" for x in params)
+        body = []
+        if r.random() < 0.4:
+            body.append(f"${r.choice(VARS)} = {expression(r, params, 1)}\n")
+        body.append(expression(r, params, 1))
+        return f"${r.choice(FUNCTIONS)}({plist}) = {{ {' '.join(body)} }}"
+    return expression(r, "")
+
+
+def program(r, definitions=False):
+    return "\n".join(line(r, definitions) for _ in range(r.randint(3, 12)))
+
+
+def programs(seed, n):
+    r = random.Random(seed)
+    return [program(r) for _ in range(n)]
@@ -0,0 +1,275 @@
+import json
+import mmap
+import os
+from datetime import datetime
+
+import pytest
+from jinja2 import FileSystemBytecodeCache
+
+from utils import budget
+from utils import jinja_render
+from utils import parse as p
+from utils import preamble
+from utils import wildcards as w
+from utils.cache import LRUCache
+from utils.fingerprints import FingerprintCache
+from utils.lora_tags import LoraTagCache
+from utils.wildcard_files import WildcardIndex
+
+
+def touch(path, text, mode="w"):
+    """Writes text to path, making sure that its mtime changes even if the file system's resolution is coarse"""
+    mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+    with open(path, mode) as f:
+        f.write(text)
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+
+def write_lora(path, tags):
+    freq = {"set": {tag: count for count, tag in tags}}
+    header = json.dumps({"__metadata__": {"ss_tag_frequency": json.dumps(freq)}}).encode()
+    touch(path, len(header).to_bytes(8, "little") + header, "wb")
+
+
+def prompt_json(text, seed):
+    return {
+        "prompt": {"1": {"class_type": w.CLASS_NAME, "inputs": {"text": text, "seed": seed}}},
+        "extra_data": {"extra_pnginfo": {}},
+    }
+
+
+def handle(text, seed=1):
+    data = w.wildcard_prompt_handler(prompt_json(text, seed))
+    return data["extra_data"]["extra_pnginfo"].get(w.CLASS_NAME, {}).get("1", text)
+
+
+@pytest.fixture
+def include(tmp_path, monkeypatch):
+    """A preamble file, used instead of the defaults"""
+    path = tmp_path / "preamble.txt"
+    touch(path, "$animal = cat\n")
+    monkeypatch.setenv("MU_WILDCARD_INCLUDE", str(path))
+    monkeypatch.setattr(preamble, "state", None)
+    monkeypatch.setattr(preamble, "trees", {})
+    return path
+
+
+def test_lru_cache_evicts_by_size():
+    c = LRUCache("test", 10, lambda k, v: len(v))
+    c.put("a", "xxxx")
+    c.put("b", "xxxx")
+    c.get("a")
+    c.put("c", "xxxx")
+    assert c.get("b") is None and c.get("a") == "xxxx" and c.size == 8
+    c.put("d", "x" * 11)
+    assert c.get("d") is None
+    c.shrink(4)
+    assert len(c) == 1 and c.get("a") == "xxxx"
+
+
+def test_parse_caches_are_keyed_on_text():
+    p.TREE_CACHE.clear()
+    p.PROGRAM_CACHE.clear()
+    assert p.run(p.cached_program("$x = a\n$x"), p.Context())[0] == "a"
+    assert p.run(p.cached_program("$x = b\n$x"), p.Context())[0] == "b"
+    assert len(p.TREE_CACHE) == len(p.PROGRAM_CACHE) == 2
+
+
+def test_preamble_reloads_changed_files(include):
+    ctx, generation = preamble.get_preamble()
+    assert preamble.get_preamble() == (ctx, generation)
+    assert p.parse("$animal", ctx.child())[0] == "cat"
+    touch(include, "$animal = dog\n")
+    assert preamble.changed_files() == [include]
+    ctx, new_generation = preamble.get_preamble(reload=True)
+    assert new_generation == generation + 1
+    assert p.parse("$animal", ctx.child())[0] == "dog"
+    assert preamble.changed_files() == []
+
+
+def test_preamble_snapshot_is_reused(include, monkeypatch):
+    tree = preamble.load_tree(include)
+    monkeypatch.setattr(preamble, "trees", {})
+    monkeypatch.setattr(p, "parse_tree", None)
+    assert preamble.load_tree(include) == tree
+
+
+def test_expansion_cache_is_invalidated_by_preamble_reload(include):
+    w.EXPANSION_CACHE.clear()
+    assert handle("a $animal") == "a cat"
+    touch(include, "$animal = dog\n")
+    # Cached until the preamble is reloaded
+    assert handle("a $animal") == "a cat"
+    preamble.get_preamble(reload=True)
+    assert handle("a $animal") == "a dog"
+    assert handle("a $animal", seed=2) == "a dog"
+
+
+def test_aborted_expansions_are_not_cached(include, tmp_path, monkeypatch):
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    monkeypatch.setitem(budget.LIMITS, "wildcard_bytes", 10)
+    w.WILDCARDS.clear()
+    w.EXPANSION_CACHE.clear()
+    touch(tmp_path / "colors.txt", "red\ngreen\nblue\n")
+    # Reading the file goes over the limit
+    assert handle("a $colors$ $animal") == "a $colors$ $animal"
+    assert len(w.EXPANSION_CACHE) == 0
+    # Once it has been read, it isn't charged for again
+    w.WILDCARDS.lookup("colors")
+    expanded = handle("a $colors$ $animal")
+    assert expanded.startswith("a ") and expanded.endswith(" cat") and "$" not in expanded
+    assert len(w.EXPANSION_CACHE) == 1
+
+
+@pytest.fixture
+def loras(tmp_path, monkeypatch):
+    """A directory of LoRAs listed by folder_paths"""
+    import folder_paths
+
+    root = tmp_path / "loras"
+    root.mkdir()
+    monkeypatch.setattr(folder_paths, "get_filename_list", lambda kind: sorted(p.name for p in root.iterdir()))
+    monkeypatch.setattr(folder_paths, "get_full_path", lambda kind, name: str(root / name))
+    return root
+
+
+def test_cached_expansions_are_invalidated_by_wildcard_file_changes(include, tmp_path, monkeypatch):
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    w.EXPANSION_CACHE.clear()
+    touch(tmp_path / "c.txt", "red\n")
+    assert handle("a $c$") == "a red"
+    assert handle("a $c$ $?c:r$") == "a red red"
+    touch(tmp_path / "c.txt", "blue\n")
+    assert handle("a $c$") == "a blue"
+    assert handle("a $c$ $?c:r$") == "a blue"
+    (tmp_path / "c.txt").unlink()
+    assert handle("a $c$") == "a c"
+
+
+def test_cached_expansions_are_invalidated_by_lora_changes(include, loras):
+    w.EXPANSION_CACHE.clear()
+    write_lora(loras / "one.safetensors", [(3, "a")])
+    assert handle("$LORA$ TAG<one>") == "one.safetensors a"
+    write_lora(loras / "one.safetensors", [(3, "b")])
+    assert handle("$LORA$ TAG<one>") == "one.safetensors b"
+    (loras / "one.safetensors").rename(loras / "two.safetensors")
+    assert handle("$LORA$ TAG<one>").strip() == "two.safetensors"
+
+
+def test_impure_expansions_are_not_cached(include, capsys):
+    w.EXPANSION_CACHE.clear()
+    assert handle("$(datetime.now().year)") == str(datetime.now().year)
+    handle("$debug(hello)")
+    handle("$debug(hello)")
+    assert capsys.readouterr().out.count("hello") == 2
+    assert len(w.EXPANSION_CACHE) == 0
+    handle("$animal")
+    assert len(w.EXPANSION_CACHE) == 1
+
+
+def test_wildcard_index_rereads_changed_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    index = WildcardIndex()
+    touch(tmp_path / "colors.txt", "red\ndark red\nblue\n")
+    assert index.lookup("colors") == ("red", "dark red", "blue")
+    assert index.lookup("colors", ("red", "!dark")) == ("red",)
+    touch(tmp_path / "colors.txt", "red\ngreen\n")
+    assert index.lookup("colors") == ("red", "green")
+    assert index.lookup("colors", ("red", "!dark")) == ("red",)
+    assert index.lookup("colors", ("e",)) == ("red", "green")
+    assert index.lookup("missing") is None
+
+
+def test_large_wildcard_index_is_rebuilt_when_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    index = WildcardIndex()
+    index.large_file_size = 0
+    touch(tmp_path / "big.txt", "red\n\ndark red\nblue\n")
+    assert list(index.lookup("big")) == ["red", "dark red", "blue"]
+    assert list(index.lookup("big", ("red", "!dark"))) == ["red"]
+    # The saved index of line offsets is used by another process, and rebuilt if the file changed
+    assert list(WildcardIndex().lookup("big") or ()) == ["red", "dark red", "blue"]
+    touch(tmp_path / "big.txt", "green\ndark red\n")
+    index = WildcardIndex()
+    index.large_file_size = 0
+    assert list(index.lookup("big")) == ["green", "dark red"]
+    assert list(index.lookup("big", ("!green",))) == ["dark red"]
+
+
+def test_lora_tags_are_reread_when_the_file_changes(tmp_path):
+    lora = tmp_path / "lora.safetensors"
+    write_lora(lora, [(3, "a"), (1, "b")])
+    cache = LoraTagCache(tmp_path / "tags.jsonl")
+    assert cache.get(str(lora)) == [(3, "a"), (1, "b")]
+    # Persisted, and read from the cache file by a new cache
+    assert LoraTagCache(tmp_path / "tags.jsonl").get(str(lora)) == [(3, "a"), (1, "b")]
+    write_lora(lora, [(5, "c")])
+    assert cache.get(str(lora)) == [(5, "c")]
+    assert LoraTagCache(tmp_path / "tags.jsonl").get(str(lora)) == [(5, "c")]
+
+
+def test_compiled_templates_are_kept_on_disk_per_template(tmp_path, monkeypatch):
+    monkeypatch.setattr(jinja_render, "BYTECODE_CACHE", FileSystemBytecodeCache(str(tmp_path)))
+    templates = ["<= 1 + 1 =>", "<% for x in range(3) %><= x =><% endfor %>", "<= 'a' * 3 =>"]
+    for t in templates:
+        jinja_render.compile_template(t)
+    assert len(list(tmp_path.iterdir())) == len(templates)
+
+    def compile(*args):
+        raise AssertionError("compiled a cached template")
+
+    monkeypatch.setattr(jinja_render.JENV, "compile", compile)
+    assert [jinja_render.compile_template(t).render() for t in templates] == ["2", "012", "aaa"]
+
+
+@pytest.mark.parametrize("filters", [("red",), ("!red",), ("red", "!dark"), ("red", "tall", "!old"), ("!a", "!e")])
+def test_large_wildcard_files_filter_like_small_ones(filters, tmp_path, monkeypatch):
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    words = ["red", "dark", "tall", "old", "blue", "x"]
+    lines = [" ".join(words[(i * k) % len(words)] for k in (1, 3, 5)) for i in range(200)]
+    touch(tmp_path / "words.txt", "\n".join(lines) + "\n")
+    large = WildcardIndex()
+    large.large_file_size = 0
+    assert list(large.lookup("words", filters)) == list(WildcardIndex().lookup("words", filters))
+
+
+def test_lora_tags_are_not_cached_when_reading_fails(tmp_path, monkeypatch):
+    lora = tmp_path / "lora.safetensors"
+    write_lora(lora, [(3, "a")])
+    cache = LoraTagCache(tmp_path / "tags.jsonl")
+
+    def fail(*args, **kwargs):
+        raise OSError("unavailable")
+
+    monkeypatch.setattr(mmap, "mmap", fail)
+    assert cache.get(str(lora)) == []
+    monkeypatch.undo()
+    assert not (tmp_path / "tags.jsonl").exists()
+    assert cache.get(str(lora)) == [(3, "a")]
+
+
+def test_fingerprints_are_kept_per_file_version(tmp_path):
+    ckpt = tmp_path / "model.safetensors"
+    touch(ckpt, "v1")
+    cache = FingerprintCache(tmp_path / "fingerprints.jsonl")
+    key, fingerprints = cache.get(str(ckpt))
+    assert fingerprints == {}
+    fingerprints["a"] = "1"
+    cache.put(str(ckpt), key, fingerprints)
+    fingerprints["b"] = "2"
+    assert cache.get(str(ckpt)) == (key, {"a": "1"})
+    assert FingerprintCache(tmp_path / "fingerprints.jsonl").get(str(ckpt)) == (key, {"a": "1"})
+    touch(ckpt, "v2")
+    assert cache.get(str(ckpt))[1] == {}
+
+
+def test_stat_cache_files_are_compacted(tmp_path):
+    ckpt = tmp_path / "model.safetensors"
+    touch(ckpt, "v1")
+    cache = FingerprintCache(tmp_path / "fingerprints.jsonl")
+    for i in range(50):
+        key, _ = cache.get(str(ckpt))
+        cache.put(str(ckpt), key, {"a": str(i)})
+    assert len((tmp_path / "fingerprints.jsonl").read_text().splitlines()) == 50
+    assert FingerprintCache(tmp_path / "fingerprints.jsonl").get(str(ckpt))[1] == {"a": "49"}
+    assert len((tmp_path / "fingerprints.jsonl").read_text().splitlines()) == 1
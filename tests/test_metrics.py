@@ -0,0 +1,12 @@
+from collections import deque
+
+from utils import metrics
+
+
+def test_slow_prompts_are_truncated(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    monkeypatch.setattr(metrics, "SLOW_PROMPT", 0)
+    monkeypatch.setattr(metrics, "slow_prompts", deque(maxlen=20))
+    with metrics.expansion("x" * (metrics.MAX_TEXT * 3), 1):
+        pass
+    assert metrics.slow_prompts[-1]["text"] == "x" * metrics.MAX_TEXT
@@ -0,0 +1,183 @@
+import gc
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lark
+import pytest
+
+from utils import fastparse
+from utils import parse as p
+from utils import preamble
+
+import corpus
+
+PROGRAMS = corpus.programs(1, 150)
+
+
+@pytest.fixture(scope="module")
+def defaults():
+    """The context of the default preamble"""
+    ctx = p.Context()
+    p.execute(p.parse_tree(preamble.include_files()[0].read_text()), ctx)
+    return ctx
+
+
+def seeded(ctx, seed="5"):
+    def factory():
+        c = ctx.child()
+        c.set("seed", p.const(seed))
+        return c
+
+    return factory
+
+
+def outcome(f, *args):
+    """Returns f(*args)[0], or the type of the exception it raises. The parsers' and engines' messages differ"""
+    try:
+        return f(*args)[0]
+    except Exception as e:
+        return type(e)
+
+
+def parse_tree(text, mode):
+    """Returns the parse tree of text, or None if it doesn't parse"""
+    try:
+        return p.parse_tree(text, mode)
+    except (lark.exceptions.LarkError, fastparse.ParseError):
+        return None
+
+
+@pytest.mark.parametrize("text", corpus.PROMPTS + PROGRAMS[:50] + [" $a=\n;=", "$a=\n\n;x $a"])
+def test_parsers_agree(text, defaults):
+    fast, earley = parse_tree(text, "fast"), parse_tree(text, "earley")
+    assert (fast is None) == (earley is None)
+    if fast is not None:
+        new = seeded(defaults)
+        assert outcome(p.execute, fast, new()) == outcome(p.execute, earley, new())
+
+
+@pytest.mark.parametrize("text", corpus.PROMPTS + PROGRAMS)
+def test_engines_agree(text, defaults):
+    new = seeded(defaults)
+    tree = parse_tree(text, "fast")
+    if tree is None:
+        return
+    assert outcome(p.execute, tree, new(), "compiled") == outcome(p.execute, tree, new(), "interpreter")
+
+
+def test_fast_parser_scales_linearly():
+    def best(n):
+        text = ("$f(a) " + "x" * 4000 + "\n") * n
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            fastparse.parse(text)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    gc.disable()
+    try:
+        ratio = best(1000) / best(250)
+    finally:
+        gc.enable()
+    assert ratio < 8
+@pytest.mark.parametrize("engine", ["compiled", "interpreter"])
+@pytest.mark.parametrize(
+    "text",
+    corpus.PROMPTS
+    + PROGRAMS[:50]
+    + [
+        "$v = $a\n$f($a) = {$v}\n$f(1) $f(2)",
+        "$a = x\n$v = $a\n$f($a) = {$v}\n$v $f(2)",
+        "$v = $a\n$a = 1\n$v\n$a = 2\n$v",
+    ],
+)
+def test_once_matches_lazy(text, engine, defaults, monkeypatch):
+    monkeypatch.setattr(p, "ENGINE", engine)
+    tree = parse_tree(text, "fast")
+    if tree is None:
+        return
+    new = seeded(defaults)
+    monkeypatch.setattr(p, "EVAL_MODE", "lazy")
+    lazy = outcome(p.execute, tree, new())
+    monkeypatch.setattr(p, "EVAL_MODE", "once")
+    assert outcome(p.execute, tree, new()) == lazy
+
+
+def expand(text, ctx, seed, incremental, monkeypatch):
+    monkeypatch.setattr(p, "PARSER", "fast")
+    monkeypatch.setattr(p, "INCREMENTAL", incremental)
+    try:
+        return p.parse(text, ctx.child(), {"seed": seed})[0]
+    except p.ExpansionLimitError as e:
+        return f"ExpansionLimitError: {e}"
+
+
+@pytest.mark.parametrize("n", range(20))
+def test_incremental_matches_full(n, monkeypatch):
+    """Expands a prompt being edited a line at a time with and without incremental expansion"""
+    r = random.Random(n)
+    ctx = p.Context()
+    p.execute(p.parse_tree(corpus.program(r, definitions=True), "fast"), ctx)
+    lines = corpus.program(r).split("\n")
+    for _ in range(10):
+        text = "\n".join(lines)
+        seed = str(r.randint(0, 2))
+        full = expand(text, ctx, seed, False, monkeypatch)
+        assert expand(text, ctx, seed, True, monkeypatch) == full, text
+        k = r.randrange(len(lines))
+        c = r.random()
+        if c < 0.5:
+            lines[k] = corpus.line(r)
+        elif c < 0.7:
+            lines.insert(k, corpus.line(r))
+        elif c < 0.8:
+            # Definitions end with the whole run of newlines after them
+            lines.insert(k, "")
+        elif len(lines) > 1:
+            del lines[k]
+
+
+@pytest.mark.parametrize("text", corpus.PROMPTS)
+def test_incremental_matches_full_on_corpus(text, defaults, monkeypatch):
+    for seed in ("1", "2"):
+        assert expand(text, defaults, seed, True, monkeypatch) == expand(text, defaults, seed, False, monkeypatch)
+
+
+PREAMBLE = """$seedtag = seed$seed
+$quality = best
+$style = masterpiece, $quality
+$punct = !
+$greet($name) = { hello $name $punct }
+"""
+
+
+@pytest.mark.parametrize("engine", ["compiled", "interpreter"])
+@pytest.mark.parametrize("mode", ["lazy", "once"])
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("$seedtag", "seed5"),
+        ("$quality = worst\n$style", "masterpiece, worst"),
+        ("$punct = ?\n$greet(bob)", "hello bob ?"),
+        ("$style, $greet(bob)", "masterpiece, best, hello bob !"),
+    ],
+)
+def test_preamble_definitions_see_prompt_variables(text, expected, engine, mode, monkeypatch):
+    monkeypatch.setattr(p, "ENGINE", engine)
+    monkeypatch.setattr(p, "EVAL_MODE", mode)
+    ctx = p.Context()
+    p.execute(p.parse_tree(PREAMBLE), ctx)
+    assert p.parse(text, ctx.child(), {"seed": "5"})[0].strip() == expected
+
+
+def test_concurrent_expansions_dont_change_preamble():
+    ctx = p.Context()
+    p.execute(p.parse_tree(PREAMBLE + "$both = $style $greet(x)\n"), ctx)
+    before = [dict(m) for m in ctx.vars.maps]
+    texts = [f"$quality = q{i}\n$punct = p{i}\n$both $seedtag" for i in range(200)]
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: p.parse(texts[i], ctx.child(), {"seed": str(i)})[0], range(len(texts))))
+    assert results == [f"masterpiece, q{i} hello x p{i} seed{i}" for i in range(len(texts))]
+    assert [dict(m) for m in ctx.vars.maps] == before
@@ -0,0 +1,147 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from utils import parse as p
+from utils import preamble
+from utils import wildcards as w
+from utils.wildcard_files import WildcardIndex
+
+COLORS = ["red", "green", "blue", "yellow", "purple", "orange"]
+ANIMALS = ["cat", "dog", "fox", "owl"]
+TEMPLATE = "a $colors$ and $?animals$\n$x = $?colors$\n$x, seed $seed"
+SEEDS = [1, 5, 10, 11, 12, 40]
+
+
+@pytest.fixture
+def wildcard_dir(tmp_path, monkeypatch):
+    """A wildcard directory with colors.txt and animals.txt, used instead of the default one"""
+    (tmp_path / "colors.txt").write_text("\n".join(COLORS) + "\n")
+    (tmp_path / "animals.txt").write_text("\n".join(ANIMALS) + "\n")
+    monkeypatch.setenv("MU_WILDCARD_BASEDIR", str(tmp_path))
+    monkeypatch.setattr(w, "WILDCARDS", WildcardIndex())
+    return tmp_path
+
+
+def expand(text, seed, mode, monkeypatch):
+    monkeypatch.setattr(w, "RNG_MODE", mode)
+    return w.expand(text, seed, p.Context())
+
+
+# Computed with the wildcard selection from before WildcardRNG, which drew from a single random.Random(seed)
+@pytest.mark.parametrize(
+    "seed, expected",
+    [
+        (1, "green cat yellow red owl owl yellow"),
+        (2, "red cat green blue fox fox orange"),
+        (3, "green dog yellow purple cat cat orange"),
+        (42, "orange cat blue orange dog dog green"),
+    ],
+)
+def test_legacy_selection_matches_older_versions(seed, expected, wildcard_dir, monkeypatch):
+    text = "$colors$ $animals$ $colors+2$ $colors$ $?animals$ $animals+1$ $colors$"
+    assert expand(text, seed, "legacy", monkeypatch) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_hashed_selection_ignores_other_wildcards(seed, wildcard_dir, monkeypatch):
+    def colors(text):
+        """The second and fourth words of the expansion of text"""
+        return expand(text, seed, "hashed", monkeypatch).split()[1:4:2]
+
+    picks = expand("$colors$ $colors+3$", seed, "hashed", monkeypatch).split()
+    assert colors("$animals$ $colors$ $animals$ $colors+3$") == picks
+    assert colors("$animals+1$ $colors$ $?animals$ $colors+3$ $animals$ $animals$") == picks
+    # Also unaffected by edits to the other wildcard files
+    (wildcard_dir / "animals.txt").write_text("eel\n")
+    w.WILDCARDS.clear()
+    assert colors("$animals$ $colors$ $animals$ $colors+3$") == picks
+
+
+@pytest.mark.parametrize("mode", ["legacy", "hashed"])
+def test_offsets(mode, wildcard_dir, monkeypatch):
+    def words(text, seed):
+        return expand(text, seed, mode, monkeypatch).split()
+
+    seeds = range(30)
+    for seed in seeds:
+        # +0 is no offset
+        assert words("$colors+0$ $animals$", seed) == words("$colors$ $animals$", seed)
+        # An offset doesn't change what is picked for the other wildcards
+        assert words("$colors+5$ $animals$ $animals$", seed)[1:] == words("$colors$ $animals$ $animals$", seed)[1:]
+    unshifted = [words("$colors$", seed) for seed in seeds]
+    for offset in (1, 2, 7):
+        picks = [words(f"$colors+{offset}$", seed) for seed in seeds]
+        assert picks != unshifted
+        assert picks == [words(f"$colors+{offset}$", seed) for seed in seeds]
+
+
+@pytest.mark.parametrize("pool", ["process", "thread"])
+def test_batches_expand_the_same_on_a_pool(pool, wildcard_dir, monkeypatch):
+    expected = list(w.expand_batch(TEMPLATE, SEEDS))
+    assert [seed for seed, _ in expected] == SEEDS
+    assert len({text for _, text in expected}) > 1
+    if pool == "thread":
+        # Used where processes can't be forked
+        monkeypatch.setattr(w.multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    assert list(w.expand_batch(TEMPLATE, SEEDS, processes=2)) == expected
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Expands the nodes of a prompt on a new pool of 4 threads"""
+    monkeypatch.setattr(w, "WORKERS", 4)
+    monkeypatch.setattr(w, "POOL", "thread")
+    monkeypatch.setattr(w, "executor", None)
+    yield
+    if w.executor is not None:
+        w.executor.shutdown()
+
+
+def test_handler_applies_results_in_prompt_order(wildcard_dir, workers, monkeypatch):
+    texts = [f"$colors$ $?animals$ {i}" for i in range(8)]
+    ctx, _ = preamble.get_preamble()
+    expected = {str(i): w.expand(t, 3, ctx) for i, t in enumerate(texts)}
+    w.EXPANSION_CACHE.clear()
+
+    try_expand = w.try_expand
+    finished = []
+    lock = threading.Lock()
+
+    def slow(text, seed, ctx):
+        # Later nodes finish first
+        i = int(text.split()[-1])
+        time.sleep(0.02 * (len(texts) - i))
+        result = try_expand(text, seed, ctx)
+        with lock:
+            finished.append(str(i))
+        return result
+
+    monkeypatch.setattr(w, "try_expand", slow)
+    data = {
+        "prompt": {str(i): {"class_type": w.CLASS_NAME, "inputs": {"text": t, "seed": 3}} for i, t in enumerate(texts)},
+        "extra_data": {"extra_pnginfo": {}},
+    }
+    info = w.wildcard_prompt_handler(data)["extra_data"]["extra_pnginfo"][w.CLASS_NAME]
+    assert finished != list(expected)
+    assert list(info.items()) == list(expected.items())
+
+
+def test_cli_expands_seed_ranges_from_stdin(wildcard_dir):
+    result = subprocess.run(
+        [sys.executable, "-m", "utils.expand_cli", "-s", "1,5,10-12,40", "-f", "-"],
+        input=TEMPLATE,
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).parent.parent,
+        env=dict(os.environ, MU_WILDCARD_BASEDIR=str(wildcard_dir)),
+        check=True,
+    )
+    lines = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [(line["seed"], line["text"]) for line in lines] == list(w.expand_batch(TEMPLATE, SEEDS))
@@ -0,0 +1,539 @@
+"""Benchmarks for the wildcard, macro and Jinja pipeline, and for weight replacement if torch is installed, that run
+without ComfyUI.
+
+Run from the node directory:
+
+    python -m utils.bench                 # everything, results as JSON on stdout
+    python -m utils.bench --quick -o a.json
+    python -m utils.bench -k wildcards -k jinja --memory
+
+Synthetic wildcard files, preambles, LoRAs and prompts are generated in a temporary directory (or --workdir,
+which is reused between runs). Each result has the time per call in seconds; with --memory, the peak of memory
+allocated during one call, measured with tracemalloc, is reported instead, and with --rss, the peak resident memory
+(Linux only, includes memory allocated by torch). Compare the output of two commits
+with --compare old.json new.json."""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+import types
+from pathlib import Path
+
+from . import comfy_stubs
+
+WORDS = "red green blue tall small old young shiny matte soft dark bright wooden metal glass stone".split()
+
+
+def write_wildcard_file(path, lines):
+    if path.exists():
+        return
+    with open(path, "w") as f:
+        for i in range(lines):
+            f.write(f"{WORDS[i % len(WORDS)]} {WORDS[(i // 7) % len(WORDS)]} item{i} tag{i % 97}\n")
+
+
+def write_lora(path, tags):
+    if path.exists():
+        return
+    freq = {"set": {f"tag_{i}": (i * 31) % 101 for i in range(tags)}}
+    header = json.dumps({"__metadata__": {"ss_tag_frequency": json.dumps(freq)}}).encode()
+    with open(path, "wb") as f:
+        f.write(len(header).to_bytes(8, "little") + header)
+
+
+def write_checkpoint(path, tensors, size):
+    """Writes a .safetensors checkpoint with tensors size x size UNet weights and a few CLIP weights. The data is
+    left as a hole in the file, so it takes no time or space to write"""
+    if path.exists():
+        return
+    header, offset = {}, 0
+    keys = [f"model.diffusion_model.{i}.weight" for i in range(tensors)]
+    shapes = [[size, size]] * tensors + [[size]] * 4
+    keys += [f"cond_stage_model.transformer.{i}.weight" for i in range(4)]
+    for key, shape in zip(keys, shapes):
+        n = 4 * shape[0] * (shape[1] if len(shape) > 1 else 1)
+        header[key] = {"dtype": "F32", "shape": shape, "data_offsets": [offset, offset + n]}
+        offset += n
+    data = json.dumps(header).encode()
+    with open(path, "wb") as f:
+        f.write(len(data).to_bytes(8, "little") + data)
+        f.truncate(8 + len(data) + offset)
+
+
+def proc_status(field):
+    """Returns a memory size from /proc/self/status in bytes"""
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith(field + ":"):
+            return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def letters(i):
+    """Variable names can only contain lowercase letters, so number them in base 26"""
+    s = ""
+    while True:
+        i, r = divmod(i, 26)
+        s = chr(ord("a") + r) + s
+        if i == 0:
+            return s
+
+
+def preamble_text(functions):
+    lines = [f"$var{letters(i)} = value {i}, {WORDS[i % len(WORDS)]}" for i in range(functions // 4)]
+    for i in range(functions):
+        n = letters(i)
+        lines.append(f"$fn{n}($a, $b=default {i}, $c=more) = {{ $a and $b, $inner{n}($c) }}")
+        lines.append(f"$inner{n}($x) = {{ inner {i} $x }}")
+    return "\n".join(lines) + "\n"
+
+
+def nested_text(depth):
+    lines = ["$na($x) = { $x }"]
+    for i in range(1, depth):
+        lines.append(f"$n{letters(i)}($x) = {{ ($n{letters(i - 1)}($x)) }}")
+    return "\n".join(lines) + f"\n$n{letters(depth - 1)}(deep)"
+
+
+def jinja_text(evaluations):
+    return ", ".join(f"$(round({i} * 0.1 + 1, 2))" for i in range(evaluations))
+
+
+def prompt_text(calls):
+    parts = ["$style = photo, detailed", "$subject($what, $where=outside) = { a $what standing $where }"]
+    parts += [f"$subject($?lines_1k:tag{i % 97}$, $where=in a $?lines_1k$ field), $style" for i in range(calls)]
+    return "\n".join(parts)
+
+
+def template_text(lines, edit=0):
+    """A template of variables, functions using them and the preamble's functions, and calls. edit changes the value
+    of the variable in the middle, which three of the other lines use"""
+    out = []
+    middle = lines // 8 * 4
+    for i in range(lines):
+        group = letters(i - i % 4)
+        if i % 4 == 0:
+            value = f"edited {edit}" if i == middle else f"{WORDS[i % len(WORDS)]} {i}"
+            out.append(f"$v{group} = {value}")
+        elif i % 4 == 1:
+            out.append(f"$t{group}($a, $b=plain) = {{ $a with $b, $v{group} }}")
+        else:
+            out.append(f"$t{group}($fn{letters(i % 7)}(x {i}), $b=$v{group})")
+    return "\n".join(out)
+
+
+def make_corpus(root, quick):
+    root.mkdir(parents=True, exist_ok=True)
+    wildcards = root / "wildcards"
+    wildcards.mkdir(exist_ok=True)
+    sizes = {"1k": 1_000, "100k": 100_000} if quick else {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+    for name, lines in sizes.items():
+        write_wildcard_file(wildcards / f"lines_{name}.txt", lines)
+    loras = root / "loras"
+    (loras / "sub").mkdir(parents=True, exist_ok=True)
+    for i in range(100 if quick else 1000):
+        write_lora(loras / ("sub" if i % 2 else "") / f"lora{i}.safetensors", 200)
+    functions = 50 if quick else 300
+    (root / "preamble.txt").write_text(preamble_text(functions))
+    checkpoint_shape = (16, 1024) if quick else (64, 2048)
+    write_checkpoint(root / f"checkpoint_{checkpoint_shape[0]}x{checkpoint_shape[1]}.safetensors", *checkpoint_shape)
+    return {
+        "quick": quick,
+        "root": root,
+        "wildcards": wildcards,
+        "loras": loras,
+        "sizes": list(sizes),
+        "functions": functions,
+        "checkpoint": root / f"checkpoint_{checkpoint_shape[0]}x{checkpoint_shape[1]}.safetensors",
+        "checkpoint_shape": checkpoint_shape,
+    }
+
+
+class Benchmark:
+    def __init__(self, name, fn, setup=None, params=None, warmup=True):
+        self.name = name
+        self.fn = fn
+        self.setup = setup or (lambda: None)
+        self.params = params or {}
+        # Makes one untimed call first, so that eg. parse trees are cached for benchmarks that don't reset them
+        self.warmup = warmup
+
+    def call(self):
+        self.setup()
+        t = time.perf_counter()
+        self.fn()
+        return time.perf_counter() - t
+
+    def time(self, rounds, min_time):
+        """Returns per call times of each round. A round runs as many calls as fit in min_time, at least one"""
+        if self.warmup:
+            self.call()
+        times = []
+        for _ in range(rounds):
+            total, calls = 0.0, 0
+            while calls == 0 or total < min_time:
+                total += self.call()
+                calls += 1
+            times.append(total / calls)
+        return times
+
+    def peak_memory(self):
+        if self.warmup:
+            self.call()
+        self.setup()
+        tracemalloc.start()
+        try:
+            self.fn()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def peak_rss(self):
+        """Returns the peak resident memory added by one call. The call runs in a forked process with its high water
+        mark reset, so that memory used earlier doesn't hide it"""
+        if self.warmup:
+            self.call()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                self.setup()
+                Path("/proc/self/clear_refs").write_text("5")
+                before = proc_status("VmRSS")
+                self.fn()
+                os.write(write, str(proc_status("VmHWM") - before).encode())
+                os._exit(0)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+        os.close(write)
+        with os.fdopen(read) as f:
+            out = f.read()
+        if os.waitpid(pid, 0)[1]:
+            raise RuntimeError(f"{self.name} failed")
+        return int(out)
+
+
+def benchmarks(corpus):
+    # Imported here so that the environment and the stubs are set up first
+    from . import parse as p
+    from . import preamble
+    from . import wildcards as w
+    from . import jinja_render as j
+
+    logging.getLogger("comfyui-misc-utils").setLevel(logging.ERROR)
+    logging.getLogger("MUWildcard").setLevel(logging.CRITICAL)
+
+    def fresh_preamble_trees():
+        preamble.trees.clear()
+
+    def cold_preamble():
+        preamble.trees.clear()
+        shutil.rmtree(preamble.CACHE_DIR, ignore_errors=True)
+
+    def cold_lora_tags():
+        w.LORA_TAGS.entries = None
+        w.LORA_TAGS.filenames = None
+        w.LORA_TAGS.path.unlink(missing_ok=True)
+
+    def rng():
+        return w.WildcardRNG(1234)
+
+    prompt = prompt_text(20)
+    # The parser sees the prompt after the first wildcard pass
+    parsed_prompt = w.replace_wildcards(prompt, rng())[0]
+    preamble_ctx = preamble.read_preamble()
+    result = []
+
+    for mode in ("earley", "fast"):
+        result.append(
+            Benchmark(f"parse_tree[{mode}]", lambda mode=mode: p.parse_tree(parsed_prompt, mode), warmup=False)
+        )
+    # The tree-walking interpreter, for comparison with the default compiled code
+    interpreter_ctx = preamble.read_preamble("interpreter")
+
+    def interpret(text):
+        return p.execute(p.cached_parse_tree(text), interpreter_ctx.child(), "interpreter")
+
+    result.append(
+        Benchmark("parse[cached tree]", lambda: p.parse(parsed_prompt, preamble_ctx.child()), params={"calls": 20})
+    )
+    result.append(Benchmark("parse[cached tree, interpreter]", lambda: interpret(parsed_prompt), params={"calls": 20}))
+    for depth in (10, 25):
+        text = nested_text(depth)
+        result.append(
+            Benchmark(
+                f"parse[nested {depth}]",
+                lambda text=text: p.parse(text, p.Context()),
+                params={"depth": depth},
+            )
+        )
+        # The same calls made with the preamble's functions in scope
+        params = {"depth": depth, "functions": corpus["functions"]}
+        result.append(
+            Benchmark(
+                f"parse[nested {depth} with preamble]",
+                lambda text=text: p.parse(text, preamble_ctx.child()),
+                params=params,
+            )
+        )
+        result.append(
+            Benchmark(
+                f"parse[nested {depth} with preamble, interpreter]", lambda text=text: interpret(text), params=params
+            )
+        )
+
+    edits = iter(range(10**9))
+
+    def edited_template(incremental):
+        p.INCREMENTAL = incremental
+        try:
+            p.parse(template_text(200, next(edits)), preamble_ctx.child(), {"seed": "1"})
+        finally:
+            p.INCREMENTAL = False
+
+    for incremental in (False, True):
+        result.append(
+            Benchmark(
+                "parse[200 line template, one line edited" + (", incremental]" if incremental else "]"),
+                lambda incremental=incremental: edited_template(incremental),
+                params={"lines": 200, "parser": p.PARSER},
+            )
+        )
+
+    params = {"functions": corpus["functions"]}
+    result.append(Benchmark("read_preamble[cold]", preamble.read_preamble, cold_preamble, params, warmup=False))
+    result.append(Benchmark("read_preamble[snapshot]", preamble.read_preamble, fresh_preamble_trees, params))
+    result.append(Benchmark("read_preamble[warm]", preamble.read_preamble, params=params))
+
+    for size in corpus["sizes"]:
+        name = f"lines_{size}"
+        text = " ".join([f"${name}$", f"${name}:tag5$", f"${name}:red:!blue$", f"${name}+100$"] * 5)
+        result.append(
+            Benchmark(
+                f"replace_wildcards[{size} cold]", lambda text=text: w.replace_wildcards(text, rng()), w.WILDCARDS.clear
+            )
+        )
+        result.append(Benchmark(f"replace_wildcards[{size} warm]", lambda text=text: w.replace_wildcards(text, rng())))
+
+    tags = " ".join(f"TAG<lora{i},5,{'r' if i % 2 else 't'}>" for i in range(0, 40, 3))
+    result.append(Benchmark("replace_lora_tags[cold]", lambda: w.replace_lora_tags(tags, 1), setup=cold_lora_tags))
+    result.append(Benchmark("replace_lora_tags[warm]", lambda: w.replace_lora_tags(tags, 1)))
+
+    template = "<% for x in steps(0, 1, 0.05) %><= round(sin(x * pi), 2) =>, <% endfor %>"
+    result.append(Benchmark("render_jinja[cold]", lambda: j.render_jinja(template), setup=j.TEMPLATE_CACHE.clear))
+    result.append(Benchmark("render_jinja[warm]", lambda: j.render_jinja(template)))
+    jinja_prompt = jinja_text(100)
+    result.append(
+        Benchmark(
+            "parse[100 jinja evaluations]",
+            lambda: p.parse(jinja_prompt, p.Context()),
+            setup=j.TEMPLATE_CACHE.clear,
+            params={"evaluations": 100},
+        )
+    )
+
+    seeds = iter(range(10**9))
+
+    def graph(nodes):
+        return {
+            "prompt": {
+                str(i): {"class_type": w.CLASS_NAME, "inputs": {"text": prompt, "seed": next(seeds)}}
+                for i in range(nodes)
+            },
+            "extra_data": {"extra_pnginfo": {}},
+        }
+
+    for nodes in (1, 4):
+        result.append(
+            Benchmark(
+                f"wildcard_prompt_handler[{nodes} nodes]",
+                lambda nodes=nodes: w.wildcard_prompt_handler(graph(nodes)),
+                params={"nodes": nodes, "workers": w.WORKERS, "pool": w.POOL},
+            )
+        )
+    return result + weight_benchmarks(corpus) + cond_benchmarks(corpus)
+
+
+def weight_benchmarks(corpus):
+    """MUReplaceModelWeights on a synthetic checkpoint, if torch is installed. Best measured with --rss"""
+    try:
+        import torch
+    except ImportError:
+        return []
+    from . import replace_model_weights as r
+    from .safetensors_file import SafetensorsFile
+
+    path = corpus["checkpoint"]
+    tensors, size = corpus["checkpoint_shape"]
+    model_config = types.SimpleNamespace(process_unet_state_dict=lambda sd: sd)
+    models = []
+
+    def model():
+        # Built once, by the setup of the first call, so that it isn't measured
+        if not models:
+            models.append(torch.nn.Sequential(*(torch.nn.Linear(size, size, bias=False) for _ in range(tensors))))
+        return models[0]
+
+    def streaming():
+        with SafetensorsFile(path) as f:
+            r.stream_unet_weights(model(), model_config, f)
+
+    fingerprints = {}
+
+    def unchanged():
+        # The same checkpoint again, with fingerprints from the earlier calls, so nothing needs to be copied
+        with SafetensorsFile(path) as f:
+            r.stream_unet_weights(model(), model_config, f, fingerprints)
+
+    def whole_checkpoint():
+        # What the node used to do: the whole state dict in memory, then load_state_dict
+        with SafetensorsFile(path) as f:
+            sd = {k: f.tensor(k) for k in f.keys()}
+        r.load_unet_weights(model(), model_config, sd)
+
+    params = {"tensors": tensors, "bytes": path.stat().st_size}
+    return [
+        Benchmark("replace_model_weights[streaming]", streaming, model, params),
+        Benchmark("replace_model_weights[streaming, unchanged]", unchanged, model, params),
+        Benchmark("replace_model_weights[whole checkpoint]", whole_checkpoint, model, params),
+    ]
+
+
+def cond_benchmarks(corpus):
+    """A chain of conditioning nodes on synthetic conds, if torch is installed. Best measured with --rss"""
+    try:
+        import torch
+    except ImportError:
+        return []
+    from . import cond
+
+    count, tokens = (8, 308) if corpus["quick"] else (32, 308)
+    conds = []
+
+    def make_conds():
+        # Built once, by the setup of the first call, so that it isn't measured
+        if not conds:
+            for i in range(count):
+                metadata = {"pooled_output": torch.randn(2, 1280), "start_percent": i / count, "control": object()}
+                conds.append([torch.randn(2, tokens, 2048), metadata])
+
+    def chain(clone):
+        cond.CLONE = clone
+        try:
+            # ComfyUI keeps the outputs of every node, so they're all kept until the end
+            outputs = [conds]
+            for i in range(2):
+                outputs.append(cond.MUConditioningCutoff().apply(outputs[-1], 0.1 * i, 0.9)[0])
+                outputs.append(cond.MURemoveControlNet().apply(outputs[-1])[0])
+            return outputs
+        finally:
+            cond.CLONE = False
+
+    params = {"conds": count, "tokens": tokens, "nodes": 4}
+    return [
+        Benchmark("cond[4 chained nodes]", lambda: chain(False), make_conds, params),
+        Benchmark("cond[4 chained nodes, cloning tensors]", lambda: chain(True), make_conds, params),
+    ]
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True
+        )
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_file, new_file):
+    old = {r["name"]: r for r in json.loads(Path(old_file).read_text())["results"]}
+    new = json.loads(Path(new_file).read_text())["results"]
+    key = next(k for k in ("median", "peak_bytes", "peak_rss_bytes") if k in new[0])
+    for r in new:
+        o = old.get(r["name"])
+        before = f"{o[key]:.6g}" if o else "-"
+        change = f"{r[key] / o[key]:.2f}x" if o and o[key] else "-"
+        print(f"{r['name']:45} {before:>14} {r[key]:>14.6g} {change:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the wildcard, macro and Jinja pipeline")
+    parser.add_argument("-k", dest="filters", action="append", default=[], help="only run benchmarks containing this")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    parser.add_argument("--quick", action="store_true", help="smaller corpora and a single round")
+    parser.add_argument("--memory", action="store_true", help="measure peak memory instead of time")
+    parser.add_argument("--rss", action="store_true", help="measure peak resident memory instead of time (Linux)")
+    parser.add_argument("--rounds", type=int, default=None, help="rounds per benchmark (default 3, 1 with --quick)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum time of a round in seconds")
+    parser.add_argument("--workdir", help="directory for the generated corpus, reused if it exists")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    root = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="mu-bench-"))
+    corpus = make_corpus(root, args.quick)
+    os.environ["MU_WILDCARD_BASEDIR"] = str(corpus["wildcards"])
+    os.environ["MU_WILDCARD_INCLUDE"] = str(root / "preamble.txt")
+    os.environ["MU_WILDCARD_CACHE_DIR"] = str(root / "cache")
+    os.environ.pop("MU_WILDCARD_WATCH", None)
+    os.environ.pop("MU_LORA_TAG_INDEX", None)
+    comfy_stubs.install(corpus["loras"])
+
+    import lark
+    import jinja2
+
+    rounds = args.rounds or (1 if args.quick else 3)
+    results = []
+    for b in benchmarks(corpus):
+        if args.filters and not any(f in b.name for f in args.filters):
+            continue
+        print(f"Running {b.name}", file=sys.stderr)
+        r = {"name": b.name, "params": b.params}
+        if args.rss:
+            r["peak_rss_bytes"] = b.peak_rss()
+        elif args.memory:
+            r["peak_bytes"] = b.peak_memory()
+        else:
+            times = b.time(rounds, args.min_time)
+            r.update({"min": min(times), "median": statistics.median(times), "rounds": times})
+        results.append(r)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "lark": lark.__version__,
+            "jinja2": jinja2.__version__,
+            "parser": os.environ.get("MU_WILDCARD_PARSER", "earley"),
+            "quick": args.quick,
+            "mode": "rss" if args.rss else "memory" if args.memory else "time",
+        },
+        "results": results,
+    }
+    out = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(out + "\n")
+    else:
+        print(out)
+    if not args.workdir:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
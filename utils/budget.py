@@ -0,0 +1,69 @@
+"""Limits on the work a single prompt expansion can do, so that a pathological prompt (eg. a function that calls
+itself, or a huge loop in Jinja) fails quickly with an error instead of tying up the server.
+
+Costs are charged to the budget of the expansion running in the current thread as they're incurred, and the
+expansion is aborted with ExpansionLimitError as soon as one goes over its limit. The costs of each expansion are
+reported through metrics, to help choose limits. A limit of 0 means no limit."""
+
+import threading
+from contextlib import contextmanager
+from os import environ
+
+from . import metrics
+
+# cost -> (environment variable, default limit)
+SETTINGS = {
+    # Variable uses, function calls and definitions
+    "steps": ("MU_WILDCARD_MAX_STEPS", 1_000_000),
+    "function_calls": ("MU_WILDCARD_MAX_CALLS", 100_000),
+    # Characters produced by variables, function calls and wildcards, including intermediate results
+    "text_chars": ("MU_WILDCARD_MAX_TEXT", 10_000_000),
+    "jinja_seconds": ("MU_WILDCARD_MAX_JINJA_SECONDS", 10),
+    # Bytes of wildcard files read or scanned
+    "wildcard_bytes": ("MU_WILDCARD_MAX_WILDCARD_BYTES", 1_000_000_000),
+}
+LIMITS = {k: float(environ.get(var, default)) or float("inf") for k, (var, default) in SETTINGS.items()}
+
+local = threading.local()
+
+
+class ExpansionLimitError(RuntimeError):
+    """Raised when a prompt expansion goes over one of its limits"""
+
+
+class Budget:
+    __slots__ = ("limits", "costs")
+
+    def __init__(self, limits=None):
+        self.limits = limits or LIMITS
+        self.costs = dict.fromkeys(SETTINGS, 0)
+
+    def charge(self, cost, amount=1, where=""):
+        total = self.costs[cost] + amount
+        self.costs[cost] = total
+        if total > self.limits[cost]:
+            raise ExpansionLimitError(
+                f"Prompt expansion went over its limit of {self.limits[cost]:g} {cost} ({SETTINGS[cost][0]}){where}"
+            )
+
+
+@contextmanager
+def expansion(limits=None):
+    """Runs an expansion with a new budget. Expansions nested in another one share its budget"""
+    outer = getattr(local, "budget", None)
+    if outer is not None:
+        yield outer
+        return
+    budget = local.budget = Budget(limits)
+    try:
+        yield budget
+    finally:
+        local.budget = None
+        metrics.costs(budget.costs)
+
+
+def charge(cost, amount=1, where=""):
+    """Charges the expansion running in this thread, if any"""
+    budget = getattr(local, "budget", None)
+    if budget is not None:
+        budget.charge(cost, amount, where)
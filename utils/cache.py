@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from os import environ
+from pathlib import Path
+
+log = logging.getLogger("comfyui-misc-utils")
+
+CACHE_DIR = Path(environ.get("MU_WILDCARD_CACHE_DIR", Path(__file__).parent.parent / "cache"))
+
+
+class LRUCache:
+    """A thread-safe LRU cache bounded by the total size of its entries.
+
+    The size of an entry is given by sizeof(key, value) and is an approximation,
+    eg. the length of the text it was computed from."""
+
+    def __init__(self, name, max_size, sizeof=lambda k, v: 1):
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                size, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.data:
+                self.size -= self.data.pop(key)[0]
+            self.data[key] = (size, value)
+            self.size += size
+            while self.size > self.max_size:
+                _, (s, _) = self.data.popitem(last=False)
+                self.size -= s
+
+    def shrink(self, max_size):
+        """Evicts least recently used entries until the total size is at most max_size"""
+        with self.lock:
+            while self.data and self.size > max_size:
+                _, (s, _) = self.data.popitem(last=False)
+                self.size -= s
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.data),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def __len__(self):
+        return len(self.data)
+
+
+class StatCache:
+    """Values computed from files, keyed by (path, size, mtime), kept in memory and appended to a JSON lines file so
+    that they survive restarts. A line for a path supersedes earlier lines for it.
+
+    field is the name of the value in the file's lines, and decode converts a value read from the file."""
+
+    def __init__(self, path, field, description, decode=lambda v: v, slack=100):
+        self.path = Path(path)
+        self.field = field
+        self.description = description
+        self.decode = decode
+        # Lines allowed in the file beyond twice the number of entries before it's compacted
+        self.slack = slack
+        # path -> ((size, mtime_ns), value)
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.entries = {}
+        lines = 0
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                        self.entries[e["path"]] = ((e["size"], e["mtime_ns"]), self.decode(e[self.field]))
+                        lines += 1
+                    except (ValueError, KeyError, TypeError):
+                        # likely a partially written line
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("Could not read %s cache %s: %s", self.description, self.path, e)
+        if lines > 2 * len(self.entries) + self.slack:
+            self.compact()
+
+    def compact(self):
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(tmp, "w", encoding="utf8") as f:
+                for path, (key, value) in self.entries.items():
+                    f.write(self.entry(path, key, value))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Could not compact %s cache %s: %s", self.description, self.path, e)
+            tmp.unlink(missing_ok=True)
+
+    def entry(self, path, key, value):
+        return json.dumps({"path": path, "size": key[0], "mtime_ns": key[1], self.field: value}) + "\n"
+
+    def get(self, path):
+        """Returns (key, value) for the file at path as it is now, with value None if it's not cached or has changed"""
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            cached = self.entries.get(path)
+        return key, cached[1] if cached and cached[0] == key else None
+
+    def put(self, path, key, value):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            if self.entries.get(path) == (key, value):
+                return
+            self.entries[path] = (key, value)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf8") as f:
+                    f.write(self.entry(path, key, value))
+            except OSError as e:
+                log.warning("Could not write to %s cache %s: %s", self.description, self.path, e)
+
+    def __len__(self):
+        return len(self.entries or ())
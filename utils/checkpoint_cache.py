@@ -0,0 +1,116 @@
+"""Keeps recently used checkpoints in host memory, so that switching back and forth between a few of them doesn't read
+them from disk every time, and reads the checkpoints of queued MUReplaceModelWeights nodes ahead of time.
+
+.safetensors files are kept as their raw contents, other checkpoints as the state dict loaded from them."""
+
+import logging
+import os
+import queue
+import threading
+from os import environ
+
+import comfy.utils
+
+from .cache import LRUCache
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+log = logging.getLogger("comfyui-misc-utils")
+
+
+def sizeof(key, value):
+    if isinstance(value, bytearray):
+        return len(value)
+    return sum(t.nbytes for t in value.values())
+
+
+# Keyed on (path, size, mtime_ns). 0 disables the cache
+CACHE = LRUCache("checkpoints", int(environ.get("MU_CHECKPOINT_CACHE_SIZE", 0)), sizeof)
+# Host memory to leave available when adding a checkpoint, evicting others to make room if needed
+MIN_AVAILABLE = int(environ.get("MU_CHECKPOINT_CACHE_MIN_AVAILABLE", 4 * 2**30))
+PREFETCH = environ.get("MU_CHECKPOINT_PREFETCH", "1") not in ("", "0")
+
+# path -> lock held while it's being read, so that a checkpoint being prefetched isn't read twice
+reading = {}
+reading_lock = threading.Lock()
+prefetch_queue = queue.Queue()
+prefetcher = None
+
+
+def cache_key(path):
+    st = os.stat(path)
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def read(path):
+    if not path.lower().endswith(".safetensors"):
+        return comfy.utils.load_torch_file(path, safe_load=True)
+    contents = bytearray(os.path.getsize(path))
+    with open(path, "rb", buffering=0) as f, memoryview(contents) as view:
+        n = 0
+        while n < len(contents):
+            r = f.readinto(view[n:])
+            if not r:
+                raise EOFError(f"{path} was truncated while reading it")
+            n += r
+    return contents
+
+
+def make_room(size, evict=True):
+    """Returns True if size bytes can be added to the cache, leaving MIN_AVAILABLE bytes of memory available. If evict
+    is True, least recently used checkpoints are evicted to make room"""
+    if size > CACHE.max_size:
+        return False
+    if not evict and CACHE.size + size > CACHE.max_size:
+        return False
+    CACHE.shrink(CACHE.max_size - size)
+    if psutil is None:
+        return True
+    short = MIN_AVAILABLE + size - psutil.virtual_memory().available
+    if short > 0 and evict:
+        CACHE.shrink(CACHE.size - short)
+        short = MIN_AVAILABLE + size - psutil.virtual_memory().available
+    return short <= 0
+
+
+def get(path, evict=True):
+    """Returns the cached contents of the checkpoint at path, reading it into the cache if it isn't there and there's
+    room for it. Returns None if it isn't cached and there's no room"""
+    if not CACHE.max_size:
+        return None
+    key = cache_key(path)
+    with reading_lock:
+        lock = reading.setdefault(path, threading.Lock())
+    with lock:
+        value = CACHE.get(key)
+        if value is None and make_room(key[1], evict):
+            value = read(path)
+            CACHE.put(key, value)
+            log.info("Read %s into memory (%.1f MiB), cached: %s", path, key[1] / 2**20, CACHE.stats())
+        # Other things may have used memory since the cached checkpoints were read
+        make_room(0, evict)
+        return value
+
+
+def prefetch(path):
+    """Reads the checkpoint at path into the cache in the background, if there's room for it without evicting others"""
+    global prefetcher
+    if not CACHE.max_size or not PREFETCH:
+        return
+    with reading_lock:
+        if prefetcher is None:
+            prefetcher = threading.Thread(target=run_prefetcher, daemon=True, name="MUCheckpointPrefetch")
+            prefetcher.start()
+    prefetch_queue.put(path)
+
+
+def run_prefetcher():
+    while True:
+        path = prefetch_queue.get()
+        try:
+            get(path, evict=False)
+        except Exception as e:
+            log.error("Prefetching %s failed: %s", path, e)
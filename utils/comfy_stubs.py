@@ -0,0 +1,43 @@
+"""Minimal stand-ins for the ComfyUI modules imported by the nodes, for running their code outside of ComfyUI.
+
+Modules that have already been imported are left alone."""
+
+import os
+import sys
+import types
+from pathlib import Path
+
+
+def module(name, **attrs):
+    m = types.ModuleType(name)
+    m.__dict__.update(attrs)
+    return sys.modules.setdefault(name, m)
+
+
+def install(lora_dir=None):
+    """Installs folder_paths, server and comfy stubs. folder_paths lists the LoRAs in lora_dir, if given"""
+    loras = []
+    if lora_dir:
+        root = Path(lora_dir)
+        loras = sorted(str(p.relative_to(root)) for p in root.rglob("*.safetensors"))
+
+    def get_filename_list(kind):
+        return loras if kind == "loras" else []
+
+    def get_full_path(kind, name):
+        return os.path.join(lora_dir, name) if lora_dir and kind == "loras" else None
+
+    module("folder_paths", get_filename_list=get_filename_list, get_full_path=get_full_path)
+
+    prompt_server = types.SimpleNamespace(instance=types.SimpleNamespace(add_on_prompt_handler=lambda f: None))
+    module("server", PromptServer=prompt_server)
+
+    if "comfy" in sys.modules:
+        return
+    comfy = module("comfy")
+    for name, attrs in [
+        ("model_management", {"soft_empty_cache": lambda *a, **k: None, "unload_all_models": lambda: None}),
+        ("utils", {}),
+        ("sd", {"CLIP": type("CLIP", (), {})}),
+    ]:
+        setattr(comfy, name, module(f"comfy.{name}", **attrs))
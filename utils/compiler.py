@@ -0,0 +1,157 @@
+"""Compiles prompt parse trees into nested Python closures, so that prompts and the functions defined in them are
+expanded without walking the tree again each time.
+
+Compiled code is a function code(vm, out) that appends its expansion to the list out, which is joined once at the
+end. vm is the TestVisitor in parse.py holding the context; the code calls back into it for variables, definitions
+and function calls, so compiled code and the tree-walking interpreter share those semantics and can call functions
+defined by each other."""
+
+from lark import Tree
+
+
+def unquote(value):
+    value = value.replace('\\"', '"')
+    if value == '""':
+        return '"'
+    return value[1:][:-1]
+
+
+def name_of(var):
+    """Returns the name of a var node, or "$" for the Jinja call $(...)"""
+    return var.children[0].value if isinstance(var, Tree) else "$"
+
+
+def nothing(vm, out):
+    pass
+
+
+def text(vm, code):
+    out = []
+    code(vm, out)
+    return "".join(out)
+
+
+def sequence(parts):
+    """Returns code appending parts in order. Parts are strings or code, and adjacent strings are joined"""
+    ops = []
+    for part in parts:
+        if isinstance(part, str):
+            if not part:
+                continue
+            if ops and isinstance(ops[-1], str):
+                ops[-1] += part
+                continue
+        ops.append(part)
+    if not ops:
+        return nothing
+    if len(ops) == 1:
+        op = ops[0]
+        if not isinstance(op, str):
+            return op
+
+        def constant(vm, out):
+            out.append(op)
+
+        return constant
+    ops = tuple(ops)
+
+    def run(vm, out):
+        for op in ops:
+            if op.__class__ is str:
+                out.append(op)
+            else:
+                op(vm, out)
+
+    return run
+
+
+def compile_var(node):
+    name = node.children[0].value
+
+    def var(vm, out):
+        out.append(vm.var_text(name))
+
+    return var
+
+
+def compile_function_call(node):
+    var, arglist = node.children
+    name = name_of(var)
+    args = []
+    for a in arglist.children:
+        if len(a.children) > 1:
+            args.append((name_of(a.children[0]), compile_tree(a.children[1])))
+        else:
+            args.append((None, compile_tree(a.children[0])))
+
+    def function_call(vm, out):
+        positional = []
+        named = {}
+        for arg, code in args:
+            value = text(vm, code)
+            if arg:
+                named[arg] = value
+            elif named:
+                raise TypeError("Can't have positional arguments after named arguments!")
+            else:
+                positional.append(value)
+        result = vm.call(name, positional, named)
+        if result:
+            out.append(result)
+
+    return function_call
+
+
+def compile_var_definition(node):
+    name = name_of(node.children[0])
+    definition = compile_tree(node.children[1]) if len(node.children) > 1 else None
+
+    def var_definition(vm, out):
+        vm.define_var(name, definition)
+
+    return var_definition
+
+
+def compile_function_definition(node):
+    var, argspec, body = node.children
+    name = name_of(var)
+    params = []
+    for a in argspec.children:
+        default = a.children[1] if len(a.children) > 1 else None
+        params.append((name_of(a.children[0]), compile_tree(default) if default is not None else None))
+    body = compile_tree(body)
+
+    def function_definition(vm, out):
+        vm.define_function(name, params, body)
+
+    return function_definition
+
+
+COMPILERS = {
+    "var": compile_var,
+    "function_call": compile_function_call,
+    "var_definition": compile_var_definition,
+    "function_definition": compile_function_definition,
+    "quoted": lambda node: unquote(node.children[0]),
+}
+
+
+def collect(node, parts):
+    if node is None:
+        return
+    if not isinstance(node, Tree):
+        parts.append(str(node))
+        return
+    compile_node = COMPILERS.get(node.data)
+    if compile_node:
+        parts.append(compile_node(node))
+    else:
+        for child in node.children:
+            collect(child, parts)
+
+
+def compile_tree(tree):
+    """Returns code expanding a parse tree"""
+    parts = []
+    collect(tree, parts)
+    return sequence(parts)
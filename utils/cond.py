@@ -1,7 +1,19 @@
 import logging
+from os import environ
 
 log = logging.getLogger("comfyui-misc-utils")
 
+# Copy conditioning tensors instead of sharing them, for workflows with nodes that modify them in place
+CLONE = environ.get("MU_COND_CLONE", "") not in ("", "0")
+
+
+def edit(c, remove=(), **changes):
+    """Returns the conditioning c with its metadata changed. The metadata dict is copied, so c is left as it was, but
+    the tensor is shared, as ComfyUI's own conditioning nodes do: nodes must not modify conditioning tensors in place"""
+    metadata = {k: v for k, v in c[1].items() if k not in remove}
+    metadata.update(changes)
+    return [c[0].clone() if CLONE else c[0], metadata]
+
 
 class MURemoveControlNet:
     @classmethod
@@ -17,15 +29,7 @@ class MURemoveControlNet:
     FUNCTION = "apply"
 
     def apply(self, conds):
-        res = []
-        for c in conds:
-            c = [c[0].clone(), c[1].copy()]
-            if "control" in c[1]:
-                del c[1]["control"]
-            if "control_apply_to_uncond" in c[1]:
-                del c[1]["control_apply_to_uncond"]
-            res.append(c)
-        return (res,)
+        return ([edit(c, remove=("control", "control_apply_to_uncond")) for c in conds],)
 
 
 class MUConditioningCutoff:
@@ -58,17 +62,10 @@ class MUConditioningCutoff:
                 end = 1.0
             if start <= start_cutoff:
                 start = 0.0
-            c = [c[0].clone(), c[1].copy()]
-            c[1]["start_percent"] = start
-            c[1]["end_percent"] = end
-            res.append(c)
+            res.append(edit(c, start_percent=start, end_percent=end))
 
         if len(res) == 0:
             log.warn("Cutoff would filter all conds, using the last one")
-            c = conds[-1]
-            c = [c[0], c[1].copy()]
-            c[1]["start_percent"] = 0.0
-            c[1]["end_percent"] = 1.0
-            res.append(c)
+            res.append(edit(conds[-1], start_percent=0.0, end_percent=1.0))
 
         return (res,)
@@ -0,0 +1,63 @@
+"""Expands a wildcard template for many seeds outside of ComfyUI and prints the results as JSON lines.
+
+Run from the node directory, eg.
+
+    python -m utils.expand_cli -s 0-9999 'a $?color$ $animal$'
+    python -m utils.expand_cli -s 1,5,100-199 -f template.txt --loras /path/to/loras
+
+The wildcard settings (MU_WILDCARD_BASEDIR, MU_WILDCARD_INCLUDE etc.) are read from the environment as usual."""
+
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+
+from . import comfy_stubs
+
+
+def parse_seeds(spec):
+    """Parses '1,5,10-19' into a list of seeds. Ranges are inclusive"""
+    seeds = []
+    for part in spec.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-", 1)
+            seeds.extend(range(int(start), int(end) + 1))
+        elif part:
+            seeds.append(int(part))
+    return seeds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expand a MUSimpleWildcard template for many seeds")
+    parser.add_argument("template", nargs="?", help="template text, or use --file")
+    parser.add_argument("-f", "--file", help="read the template from a file, - for stdin")
+    parser.add_argument("-s", "--seeds", default="0", help="seeds to expand, eg. 0-9999 or 1,5,10-19")
+    parser.add_argument("-p", "--processes", type=int, default=0, help="number of worker processes")
+    parser.add_argument("--loras", help="directory of LoRAs for $LORA$ and TAG<...>")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every wildcard selection")
+    args = parser.parse_args(argv)
+
+    if args.file == "-":
+        template = sys.stdin.read()
+    elif args.file:
+        template = Path(args.file).read_text()
+    elif args.template is not None:
+        template = args.template
+    else:
+        parser.error("a template or --file is required")
+
+    comfy_stubs.install(args.loras)
+    from .wildcards import expand_batch
+
+    logging.getLogger("comfyui-misc-utils").setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    out = sys.stdout
+    for seed, text in expand_batch(template, parse_seeds(args.seeds), processes=args.processes):
+        out.write(json.dumps({"seed": seed, "text": text}) + "\n")
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import re
+from lark import Tree, Token
+
+# Hand-written recursive descent parser for the grammar in parse.py.
+# It produces the same tree shapes as the Earley parser so that TestVisitor can
+# be used unchanged, but runs in linear time and needs no grammar construction.
+
+VAR_RE = re.compile(r"\$(?:\{([a-z]+)\}|([a-z]+))")
+VAR_DEF_RE = re.compile(r"\$(?:\{[a-z]+\}|[a-z]+)[ \t]*=")
+FUNC_DEF_RE = re.compile(r"\$(?:\{[a-z]+\}|[a-z]+)\(")
+STRING_RE = re.compile(r'[^"$(){},;\n]+')
+WS_RE = re.compile(r"[ \t]+")
+NEWLINE_RE = re.compile(r"(\r?\n)+")
+QUOTED_RE = re.compile(r'".*?(?<!\\)(\\\\)*?"')
+COMMAS_RE = re.compile(",*")
+DEFAULT_SEP_RE = re.compile(r",[ \t]*\$(?:\{[a-z]+\}|[a-z]+)[ \t]*[,=)]")
+
+CLOSING = {"(": ")", "{": "}"}
+BRACKET_TOKENS = {"(": "LPAR", ")": "RPAR", "{": "LBRACE", "}": "RBRACE"}
+
+# expression contexts
+ITEM = "item"
+DEFVALUE = "defvalue"
+BLOCK = "block"
+ARG = "arg"
+DEFAULT = "default"
+
+
+class ParseError(ValueError):
+    def __init__(self, text, pos, expected):
+        # The message is only built when shown: errors are raised and caught while backtracking,
+        # and finding the line of every one would make parsing quadratic
+        super().__init__(text, pos, expected)
+        self.text = text
+        self.pos = pos
+        self.expected = expected
+
+    def __str__(self):
+        line = self.text.count("\n", 0, self.pos) + 1
+        col = self.pos - self.text.rfind("\n", 0, self.pos)
+        snippet = self.text[self.pos : self.pos + 20]
+        return f"Unexpected input at line {line} col {col}, expected {self.expected}: {snippet!r}"
+
+
+class PromptParser:
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.end = len(text)
+
+    def error(self, expected):
+        raise ParseError(self.text, self.pos, expected)
+
+    def peek(self):
+        return self.text[self.pos] if self.pos < self.end else ""
+
+    def match(self, regexp):
+        m = regexp.match(self.text, self.pos)
+        if m:
+            self.pos = m.end()
+        return m
+
+    def skip_ws(self):
+        self.match(WS_RE)
+
+    def expect(self, c):
+        if self.peek() != c:
+            self.error(repr(c))
+        self.pos += 1
+
+    def parse(self):
+        items = self.items(None)
+        if self.pos < self.end:
+            self.error("end of input")
+        return Tree("start", items)
+
+    def items(self, closing):
+        items = []
+        while self.pos < self.end and self.peek() != closing:
+            if self.peek() == "$":
+                d = self.definition()
+                if d:
+                    items.append(d)
+                    continue
+            m = self.match(NEWLINE_RE)
+            if m:
+                items.append(Tree("expr", [Token("NEWLINE", m.group())]))
+                continue
+            e = self.expr(ITEM)
+            if not e:
+                self.error("expression")
+            items.append(e)
+        return items
+
+    def at_definition(self):
+        if VAR_DEF_RE.match(self.text, self.pos):
+            return True
+        if FUNC_DEF_RE.match(self.text, self.pos):
+            start = self.pos
+            d = self.definition()
+            self.pos = start
+            return d is not None
+        return False
+
+    def definition(self):
+        start = self.pos
+        if not VAR_RE.match(self.text, self.pos):
+            return None
+        var = self.var()
+        if self.peek() == "(":
+            try:
+                argspec = self.argument_spec()
+                self.skip_ws()
+                self.expect("=")
+                self.skip_ws()
+                self.expect("{")
+                body = self.items("}")
+                self.expect("}")
+            except ParseError:
+                self.pos = start
+                return None
+            d = Tree("function_definition", [var, argspec, Tree("function_body", body)])
+            if any(has_singles(a.children[1]) for a in argspec.children):
+                # Commas in default values make this ambiguous with a function call followed by a block.
+                # Pick whichever the Earley parser would, by priority
+                end = self.pos
+                alternative = self.call_and_block(start)
+                if alternative and self.pos == end and score(alternative) > score(d):
+                    self.pos = start
+                    return None
+                self.pos = end
+            return d
+
+        self.skip_ws()
+        if self.peek() != "=":
+            self.pos = start
+            return None
+        self.pos += 1
+        self.skip_ws()
+        children = [var]
+        e = self.expr(DEFVALUE)
+        if e:
+            children.append(e)
+        else:
+            # Like the Earley parser, take newlines followed by ";" as the value, with ";" ending the definition
+            m = NEWLINE_RE.match(self.text, self.pos)
+            if m and self.text.startswith(";", m.end()):
+                children.append(Tree("expr", [Token("NEWLINE", m.group())]))
+                self.pos = m.end()
+        if self.peek() == ";":
+            self.pos += 1
+        else:
+            self.match(NEWLINE_RE)
+        return Tree("var_definition", children)
+
+    def call_and_block(self, start):
+        self.pos = start
+        try:
+            call = self.function_call_or_var()
+            self.skip_ws()
+            self.expect("=")
+            self.skip_ws()
+            if self.peek() != "{":
+                return None
+            return [call, self.block()]
+        except ParseError:
+            return None
+
+    def var(self):
+        m = self.match(VAR_RE)
+        if not m:
+            self.error("variable")
+        return Tree("var", [Token("NAME", m.group(1) or m.group(2))])
+
+    def argument_spec(self):
+        self.expect("(")
+        self.skip_ws()
+        args = []
+        if self.peek() == "$":
+            args.append(self.argument())
+            self.skip_ws()
+        while self.peek() == ",":
+            self.pos += 1
+            self.skip_ws()
+            args.append(self.argument())
+            self.skip_ws()
+        self.expect(")")
+        return Tree("argument_spec", args)
+
+    def argument(self):
+        var = self.var()
+        self.skip_ws()
+        defval = None
+        if self.peek() == "=":
+            self.pos += 1
+            self.arg_ws()
+            defval = self.expr(DEFAULT)
+            if not defval:
+                self.error("default value")
+        return Tree("argument", [var, defval])
+
+    def argument_list(self):
+        self.expect("(")
+        args = []
+        self.arg_ws()
+        # The first argument may be omitted. In a run of leading commas, every
+        # other one is a separator, so whether the run starts with one depends on its length
+        commas = len(COMMAS_RE.match(self.text, self.pos).group())
+        if self.peek() != ")" and not (self.at_separator() and commas % 2):
+            args.append(self.argvalue())
+            self.skip_ws()
+        while self.at_separator():
+            self.pos += 1
+            self.arg_ws()
+            args.append(self.argvalue())
+            self.skip_ws()
+        self.expect(")")
+        return Tree("argument_list", args)
+
+    def at_separator(self):
+        # A trailing comma is part of the last argument
+        return self.peek() == "," and self.text[self.pos + 1 : self.pos + 2] != ")"
+
+    def at_argument_end(self, context):
+        if context == ARG:
+            return self.peek() == ")" or self.at_separator()
+        if context == DEFAULT:
+            return self.peek() == ")" or DEFAULT_SEP_RE.match(self.text, self.pos) is not None
+        return False
+
+    def arg_ws(self):
+        # Leading whitespace is dropped unless it's the whole argument
+        start = self.pos
+        self.skip_ws()
+        if self.peek() == ")" or self.at_separator():
+            self.pos = start
+
+    def argvalue(self):
+        start = self.pos
+        if VAR_DEF_RE.match(self.text, self.pos):
+            var = self.var()
+            self.skip_ws()
+            self.expect("=")
+            e = None if self.at_separator() else self.expr(ARG)
+            if e:
+                return Tree("argvalue", [var, e])
+            self.pos = start
+        e = self.expr(ARG)
+        if not e:
+            self.error("argument")
+        return Tree("argvalue", [e])
+
+    def expr(self, context):
+        if context in (BLOCK, ARG):
+            m = self.match(NEWLINE_RE)
+            if m:
+                return Tree("expr", [Token("NEWLINE", m.group())])
+        prompts = []
+        while self.pos < self.end:
+            c = self.text[self.pos]
+            if c == "$":
+                if context in (ITEM, DEFVALUE) and self.at_definition():
+                    break
+                prompts.append(Tree("prompt", [self.function_call_or_var()]))
+            elif c == '"':
+                m = self.match(QUOTED_RE)
+                if not m:
+                    self.error("closing quote")
+                prompts.append(Tree("prompt", [Tree("quoted", [Token("ESCAPED_STRING", m.group())])]))
+            elif c in "({":
+                prompts.append(Tree("prompt", [self.block()]))
+            elif c == ",":
+                if prompts and self.at_argument_end(context):
+                    break
+                self.pos += 1
+                prompts.append(Tree("prompt", [Token("SINGLES", c)]))
+            elif c == ";":
+                if context == DEFVALUE:
+                    break
+                self.pos += 1
+                prompts.append(Tree("prompt", [Token("SINGLES", c)]))
+            elif c in ")}\n":
+                break
+            else:
+                start = self.pos
+                s = self.match(STRING_RE).group()
+                if prompts and not s.strip() and self.at_argument_end(context):
+                    # Trailing whitespace after an argument is a separator, not a part of it
+                    self.pos = start
+                    break
+                prompts.append(Tree("prompt", [Token("STRING", s)]))
+        if not prompts:
+            return None
+        return Tree("expr", prompts)
+
+    def function_call_or_var(self):
+        if self.text.startswith("$(", self.pos):
+            self.pos += 1
+            return Tree("function_call", [Token("DOLLAR", "$"), self.argument_list()])
+        var = self.var()
+        if self.peek() == "(":
+            return Tree("function_call", [var, self.argument_list()])
+        return var
+
+    def block(self):
+        open = self.text[self.pos]
+        close = CLOSING[open]
+        self.pos += 1
+        children = [Token(BRACKET_TOKENS[open], open)]
+        e = self.expr(BLOCK)
+        if e:
+            children.append(e)
+        if self.peek() != close:
+            self.error(repr(close))
+        self.pos += 1
+        children.append(Token(BRACKET_TOKENS[close], close))
+        return Tree("block", children)
+
+
+# Rule and terminal priorities from the grammar, used to resolve ambiguities
+PRIORITIES = {
+    "var_definition": 10,
+    "function_definition": 10,
+    "function_call": 10,
+    "var": 5,
+    "argument_spec": 10,
+    "argument": 10,
+    "argvalue": 10,
+    "argument_list": 10,
+    "function_body": 20,
+}
+SEPARATED = ("argument_spec", "argument_list")
+
+
+def has_singles(tree):
+    return tree is not None and any(t.type == "SINGLES" for t in tree.scan_values(lambda x: isinstance(x, Token)))
+
+
+def score(tree):
+    if isinstance(tree, list):
+        return sum(score(x) for x in tree)
+    if tree is None:
+        return 0
+    if isinstance(tree, Token):
+        return -10 if tree.type == "SINGLES" else 0
+    s = PRIORITIES.get(tree.data, 0) + sum(score(c) for c in tree.children)
+    if tree.data in SEPARATED:
+        s += max(len(tree.children) - 1, 0)
+    return s
+
+
+def parse(text):
+    return PromptParser(text).parse()
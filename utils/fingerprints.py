@@ -0,0 +1,21 @@
+from .cache import CACHE_DIR, StatCache
+
+
+class FingerprintCache(StatCache):
+    """Fingerprints of the tensors in checkpoint files keyed by (path, size, mtime), kept in memory and appended to a
+    JSON lines file so that they survive restarts"""
+
+    def __init__(self, path=CACHE_DIR / "tensor_fingerprints.jsonl"):
+        super().__init__(path, "tensors", "tensor fingerprint", slack=20)
+
+    def get(self, path):
+        """Returns (key, {tensor: fingerprint}) for the file at path as it is now. The fingerprints are a copy, and
+        empty if none are cached"""
+        key, tensors = super().get(path)
+        return key, dict(tensors or {})
+
+    def put(self, path, key, tensors):
+        super().put(path, key, dict(tensors))
+
+    def stats(self):
+        return {"checkpoints": len(self)}
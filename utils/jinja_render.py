@@ -1,10 +1,17 @@
+import hashlib
 import logging
 import math
 import re
+import time
 from datetime import datetime
-from jinja2 import Environment
+from os import environ
+from jinja2 import Environment, FileSystemBytecodeCache
 from jinja2.exceptions import TemplateSyntaxError
 
+from .cache import LRUCache
+from . import budget
+from . import metrics
+
 log = logging.getLogger("comfyui-misc-utils")
 
 
@@ -13,6 +20,7 @@ def steps(start, end=None, step=0.1):
         end = start
         start = step
     while start <= end:
+        budget.charge("steps", 1, ", in steps()")
         yield start
         start += step
         start = round(start, 2)
@@ -53,8 +61,8 @@ for fname in ["sqrt", "sin", "cos", "tan", "asin", "acos", "atan"]:
     JINJA_ENV[fname] = lambda x: round(f(x), 2)
 
 
-def render_jinja(text):
-    jenv = Environment(
+def make_environment():
+    return Environment(
         block_start_string="<%",
         block_end_string="%>",
         variable_start_string="<=",
@@ -63,7 +71,54 @@ def render_jinja(text):
         comment_end_string="#>",
     )
 
-    return jenv.from_string(text, globals=JINJA_ENV).render()
+
+JENV = make_environment()
+JENV.globals.update(JINJA_ENV)
+
+# Compiled templates keyed on their source
+TEMPLATE_CACHE = LRUCache("templates", int(environ.get("MU_JINJA_CACHE_SIZE", 1_000_000)), lambda k, v: len(k))
+
+# Optional on-disk cache of compiled template code, so that templates survive restarts
+BYTECODE_CACHE = None
+if environ.get("MU_JINJA_CACHE_DIR"):
+    BYTECODE_CACHE = FileSystemBytecodeCache(environ["MU_JINJA_CACHE_DIR"])
+
+
+def compile_template(text):
+    if BYTECODE_CACHE is None:
+        return JENV.from_string(text)
+    # This is what jinja2 loaders do with a bytecode cache, but from_string doesn't use one. Templates have no name,
+    # so the bucket, ie. the file, is named after the source
+    bucket = BYTECODE_CACHE.get_bucket(JENV, hashlib.sha1(text.encode()).hexdigest(), None, text)
+    if bucket.code is None:
+        bucket.code = JENV.compile(text)
+        BYTECODE_CACHE.set_bucket(bucket)
+    return JENV.template_class.from_code(JENV, bucket.code, JENV.make_globals(None))
+
+
+def render_jinja(text):
+    metrics.count("jinja_renders")
+    with metrics.stage("jinja"):
+        template = TEMPLATE_CACHE.get(text)
+        if template is None:
+            template = compile_template(text)
+            TEMPLATE_CACHE.put(text, template)
+        return render_within_budget(template)
+
+
+def render_within_budget(template):
+    """Renders template, charging the time taken to the expansion's budget every few pieces of output so that a
+    template that runs for too long is stopped"""
+    out = []
+    last = time.perf_counter()
+    for piece in template.generate():
+        out.append(piece)
+        if len(out) % 64 == 0:
+            now = time.perf_counter()
+            budget.charge("jinja_seconds", now - last, ", rendering Jinja")
+            last = now
+    budget.charge("jinja_seconds", time.perf_counter() - last, ", rendering Jinja")
+    return "".join(out)
 
 
 class MUJinjaRender:
@@ -79,9 +134,20 @@ class MUJinjaRender:
     def render(self, text):
         t = text
         try:
-            t = render_jinja(text)
-        except TemplateSyntaxError as e:
+            with budget.expansion():
+                t = render_jinja(text)
+        except (TemplateSyntaxError, budget.ExpansionLimitError) as e:
             log.error("MUJinjaRender failed to render template: %s\n%s", e, text)
         if t.strip() != text.strip():
             log.info("Jinja render result: %s", re.sub("\s+", " ", t, flags=re.MULTILINE))
         return (t,)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    n = 2000
+    for text in ["<= 1 + 2 =>", "<% for x in steps(0, 1, 0.1) %><= round(x * 2, 2) =>, <% endfor %>"]:
+        uncached = timeit.timeit(lambda: make_environment().from_string(text, globals=JINJA_ENV).render(), number=n)
+        cached = timeit.timeit(lambda: render_jinja(text), number=n)
+        print(f"{text!r}: new environment per call {uncached / n * 1e6:.1f}us, cached {cached / n * 1e6:.1f}us")
@@ -0,0 +1,123 @@
+import json
+import logging
+import mmap
+import os
+import threading
+from os import environ
+from pathlib import Path
+
+from . import metrics
+from .cache import CACHE_DIR, StatCache
+
+log = logging.getLogger("comfyui-misc-utils")
+
+try:
+    import folder_paths
+except ImportError:
+    folder_paths = None
+
+
+def load_lora_meta(filename):
+    """Returns the metadata of a LoRA, or None if it can't be read"""
+    try:
+        with open(filename, "r", encoding="utf8") as f:
+            with mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ) as m:
+                header = m.read(8)
+                n = int.from_bytes(header, "little")
+                metadata_bytes = m.read(n)
+                return json.loads(metadata_bytes).get("__metadata__", {})
+    except Exception as e:
+        log.error("Metadata load failed for %s: %s", filename, e)
+        return None
+
+
+def count_tags(meta):
+    """Returns [(count, tag)] from the ss_tag_frequency of a LoRA's metadata, most frequent first"""
+    tags = json.loads(meta.get("ss_tag_frequency", "{}"))
+    tagcounts = {}
+    for k in tags:
+        for tag, count in tags[k].items():
+            t = tag.strip().replace("_", " ")
+            tagcounts[t] = tagcounts.get(t, 0) + count
+    alltags = [(v, k) for k, v in tagcounts.items()]
+    return sorted(alltags, reverse=True)
+
+
+class LoraTagCache(StatCache):
+    """Sorted tag counts of LoRAs keyed by (path, size, mtime), kept in memory and appended to a JSON lines file
+    so that they survive restarts"""
+
+    def __init__(self, path=CACHE_DIR / "lora_tags.jsonl"):
+        super().__init__(path, "tags", "LoRA tag", decode=lambda tags: [tuple(t) for t in tags])
+        # stem -> path, built from the filename list it was computed from
+        self.stems = {}
+        self.filenames = None
+
+    def find(self, name):
+        """Returns the full path of the first LoRA whose file name without extension is name, or None"""
+        filenames = folder_paths.get_filename_list("loras")
+        with self.lock:
+            if filenames != self.filenames:
+                stems = {}
+                for f in filenames:
+                    stems.setdefault(Path(f).stem, f)
+                self.stems = stems
+                self.filenames = list(filenames)
+            f = self.stems.get(name)
+        return folder_paths.get_full_path("loras", f) if f else None
+
+    def get(self, path):
+        """Returns [(count, tag)] for the LoRA at path, reading its metadata only if it's not cached or has changed"""
+        key, tags = super().get(path)
+        if tags is not None:
+            return tags
+        metrics.count("lora_metadata_reads")
+        meta = load_lora_meta(path)
+        if meta is None:
+            # Not cached, so that it's read again next time, eg. if it failed because the file was being written
+            return []
+        tags = count_tags(meta)
+        self.put(path, key, tags)
+        return tags
+
+    def lora_tags(self, name):
+        found = self.find(name)
+        if not found:
+            return []
+        try:
+            return self.get(found)
+        except OSError as e:
+            log.error("Could not read tags for %s: %s", found, e)
+            return []
+
+    def version(self, name):
+        """Returns (path, size, mtime) of the LoRA name, or None if there's none"""
+        if folder_paths is None:
+            return None
+        found = self.find(name)
+        try:
+            st = os.stat(found) if found else None
+        except OSError:
+            st = None
+        return (found, st.st_size, st.st_mtime_ns) if st else None
+
+    def index_all(self):
+        for f in folder_paths.get_filename_list("loras"):
+            self.lora_tags(Path(f).stem)
+
+    def stats(self):
+        return {"loras": len(self.stems), "tags": len(self)}
+
+
+def start_indexer(cache):
+    """Reads the tags of all LoRAs in the background at startup if MU_LORA_TAG_INDEX is set"""
+    if environ.get("MU_LORA_TAG_INDEX") and folder_paths is not None:
+
+        def run():
+            try:
+                cache.index_all()
+                log.info("Indexed LoRA tags: %s", cache.stats())
+            except Exception as e:
+                log.error("LoRA tag indexer failed: %s", e)
+
+        threading.Thread(target=run, daemon=True, name="MULoraTagIndexer").start()
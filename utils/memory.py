@@ -1,23 +1,244 @@
 import gc
+import json
+import sys
+import threading
+import time
+import tracemalloc
 import comfy.model_management
 import logging
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
 log = logging.getLogger("comfyui-misc-utils")
 
+# Resident memory after the last full collection, which RSS growth is measured from
+last_full = {"rss": None}
+# The tracemalloc snapshot of the previous allocation report, which growth is measured from
+tracing = {"snapshot": None}
+tracing_lock = threading.Lock()
+
+
+def rss():
+    """Returns the resident memory of the process in bytes, or None if it can't be measured"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_snapshot():
+    s = {"rss": rss(), "gc_counts": gc.get_count(), "gc_collected": [g["collected"] for g in gc.get_stats()]}
+    if torch is not None and torch.cuda.is_available():
+        s["cuda_allocated"] = torch.cuda.memory_allocated()
+        s["cuda_reserved"] = torch.cuda.memory_reserved()
+    return s
+
+
+def clear(mode="always", rss_growth=1024 * 2**20, gen2_count=10):
+    """Collects garbage and empties the CUDA cache, and returns a report of what it did and of memory use before and
+    after. With mode "threshold", a full collection is only done if RSS has grown by rss_growth bytes since the last
+    one, or if there have been gen2_count generation 1 collections since the last one; otherwise only the younger
+    generations are collected"""
+    before = memory_snapshot()
+    growth = None
+    if before["rss"] is not None and last_full["rss"] is not None:
+        growth = before["rss"] - last_full["rss"]
+    full = mode != "threshold" or (growth is not None and growth >= rss_growth) or before["gc_counts"][2] >= gen2_count
+    start = time.perf_counter()
+    collected = gc.collect(2 if full else 1)
+    if full:
+        comfy.model_management.soft_empty_cache(True)
+    duration = time.perf_counter() - start
+    after = memory_snapshot()
+    if full or last_full["rss"] is None:
+        last_full["rss"] = after["rss"]
+    return {
+        "mode": mode,
+        "generation": 2 if full else 1,
+        "rss_growth": growth,
+        "collected": collected,
+        "seconds": round(duration, 4),
+        "before": before,
+        "after": after,
+    }
+
 
 class MUForceCacheClear:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": {"model": ("MODEL",)}}
+        return {
+            "required": {"model": ("MODEL",)},
+            "optional": {
+                "mode": (["always", "threshold"], {"default": "always"}),
+                "rss_growth_mb": ("INT", {"default": 1024, "min": 0, "max": 2**20}),
+                "gen2_count": ("INT", {"default": 10, "min": 0, "max": 10000}),
+            },
+        }
 
     NOT_IDEMPOTENT = True
-    RETURN_TYPES = ("MODEL",)
+    RETURN_TYPES = ("MODEL", "STRING")
+    RETURN_NAMES = ("model", "report")
     FUNCTION = "do"
 
     CATEGORY = "utils"
 
-    def do(self, model):
-        log.info("Running Python GC and clearing CUDA cache")
-        gc.collect()
-        comfy.model_management.soft_empty_cache(True)
-        return (model,)
+    def do(self, model, mode="always", rss_growth_mb=1024, gen2_count=10):
+        report = clear(mode, rss_growth_mb * 2**20, gen2_count)
+        report = json.dumps(report)
+        log.info("Ran Python GC: %s", report)
+        return (model, report)
+
+
+def start_tracing(frames=1):
+    """Starts tracing allocations with tracemalloc, keeping frames frames of each allocation's traceback. Until
+    then, tracing costs nothing"""
+    with tracing_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        tracing["snapshot"] = None
+
+
+def stop_tracing():
+    with tracing_lock:
+        tracemalloc.stop()
+        tracing["snapshot"] = None
+
+
+def stat_entry(stat):
+    frames = [f"{f.filename}:{f.lineno}" for f in stat.traceback]
+    e = {"site": frames[0], "size": stat.size, "count": stat.count}
+    if len(frames) > 1:
+        e["traceback"] = frames
+    if hasattr(stat, "size_diff"):
+        e.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+    return e
+
+
+def allocation_report(top=20):
+    """Returns the top allocation sites, and their growth since the previous report, or None if not tracing"""
+    with tracing_lock:
+        if not tracemalloc.is_tracing():
+            return None
+        key = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        previous, tracing["snapshot"] = tracing["snapshot"], snapshot
+        traced, peak = tracemalloc.get_traced_memory()
+    report = {"traced": traced, "peak": peak, "top": [stat_entry(s) for s in snapshot.statistics(key)[:top]]}
+    if previous is not None:
+        report["growth"] = [stat_entry(s) for s in snapshot.compare_to(previous, key)[:top]]
+    return report
+
+
+def package_structures():
+    """Returns the sizes of this package's caches and global structures, for the modules that are loaded"""
+
+    def loaded(name):
+        return sys.modules.get(f"{__package__}.{name}")
+
+    s = {"gc_objects": len(gc.get_objects())}
+    if w := loaded("wildcards"):
+        s["caches"] = w.cache_stats()
+    if (p := loaded("preamble")) and p.state:
+        ctx, generation = p.state
+        s["preamble"] = {
+            "generation": generation,
+            "files": len(p.trees),
+            "scopes": len(ctx.vars.maps),
+            "names": sum(len(m) for m in ctx.vars.maps),
+        }
+    if m := loaded("metrics"):
+        s["metrics"] = {
+            "stages": len(m.histograms),
+            "counters": len(m.counters),
+            "slow_prompts": len(m.slow_prompts),
+            "recent_costs": len(m.recent_costs),
+        }
+    if r := loaded("replace_model_weights"):
+        s["replace_model_weights"] = {
+            "tracked_modules": len(r.LOADED),
+            "reused_clips": len(r.CLIPS),
+            "fingerprints": r.FINGERPRINTS.stats(),
+        }
+    if c := loaded("checkpoint_cache"):
+        s["checkpoint_cache"] = c.CACHE.stats()
+    return s
+
+
+def diagnostics(top=20):
+    return {"memory": memory_snapshot(), "structures": package_structures(), "allocations": allocation_report(top)}
+
+
+class MUMemoryDiagnostics:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "tracing": (["unchanged", "start", "stop"], {"default": "unchanged"}),
+                "top": ("INT", {"default": 20, "min": 1, "max": 1000}),
+                "frames": ("INT", {"default": 1, "min": 1, "max": 100}),
+            }
+        }
+
+    NOT_IDEMPOTENT = True
+    OUTPUT_NODE = True
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("report",)
+    FUNCTION = "do"
+
+    CATEGORY = "utils"
+
+    @classmethod
+    def IS_CHANGED(s, **kwargs):
+        return float("nan")
+
+    def do(self, tracing, top, frames):
+        if tracing == "start":
+            start_tracing(frames)
+        elif tracing == "stop":
+            stop_tracing()
+        report = json.dumps(diagnostics(top))
+        log.info("Memory diagnostics: %s", report)
+        return (report,)
+
+
+def add_routes(server):
+    """Adds /mu_utils/memory, which returns diagnostics(top), to the ComfyUI server. POST
+    {"tracing": true/false, "frames": n} to /mu_utils/memory/tracing to start or stop tracing allocations"""
+    if not hasattr(server, "routes"):
+        return
+    from aiohttp import web
+
+    @server.routes.get("/mu_utils/memory")
+    async def memory_json(request):
+        return web.json_response(diagnostics(int(request.query.get("top", 20))))
+
+    @server.routes.post("/mu_utils/memory/tracing")
+    async def memory_tracing(request):
+        body = await request.json()
+        if body.get("tracing"):
+            start_tracing(int(body.get("frames", 1)))
+        else:
+            stop_tracing()
+        return web.json_response({"tracing": tracemalloc.is_tracing()})
+
+
+try:
+    from server import PromptServer
+
+    add_routes(PromptServer.instance)
+except ImportError:
+    pass
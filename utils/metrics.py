@@ -0,0 +1,218 @@
+"""Optional timing and counters for prompt expansion, enabled with MU_WILDCARD_METRICS=1.
+
+Stages can nest (eg. Jinja evaluation happens during macro expansion), and each reports its own inclusive time.
+Metrics are collected per process, so expansions done in worker processes (MU_WILDCARD_POOL=process) aren't
+included."""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from os import environ
+
+log = logging.getLogger("comfyui-misc-utils")
+
+ENABLED = environ.get("MU_WILDCARD_METRICS", "") not in ("", "0")
+# Expansions taking at least this many seconds are logged with their stage breakdown
+SLOW_PROMPT = float(environ.get("MU_WILDCARD_SLOW_PROMPT", 5))
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+# Slow prompts are logged and kept up to this many characters
+MAX_TEXT = 2000
+
+lock = threading.Lock()
+# stage -> [counts per bucket and one for larger values, sum of seconds]
+histograms = {}
+counters = {}
+slow_prompts = deque(maxlen=20)
+# cost -> [expansions, total, maximum], see budget.py
+cost_totals = {}
+recent_costs = deque(maxlen=100)
+# Stage times and counts of the expansion running in the current thread
+local = threading.local()
+
+
+class Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Expansion:
+    def __init__(self, text, seed):
+        self.text = text
+        self.seed = seed
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        local.stages = {}
+        local.counts = {}
+        return self
+
+    def __exit__(self, *exc):
+        total = time.perf_counter() - self.start
+        stages, counts = local.stages, local.counts
+        local.stages = local.counts = None
+        observe("total", total)
+        if total >= SLOW_PROMPT:
+            count("slow_prompts")
+            text = self.text[:MAX_TEXT]
+            breakdown = ", ".join(f"{k} {v:.3f}s" for k, v in stages.items())
+            log.warning("Slow prompt expansion took %.3fs (%s), counts %s, text:\n%s", total, breakdown, counts, text)
+            slow_prompts.append(
+                {
+                    "time": time.time(),
+                    "seconds": total,
+                    "stages": stages,
+                    "counts": counts,
+                    "seed": self.seed,
+                    "text": text,
+                }
+            )
+        return False
+
+
+class NoOp:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP = NoOp()
+
+
+def stage(name):
+    """Returns a context manager that times a stage, or does nothing if metrics are disabled"""
+    return Stage(name) if ENABLED else NOOP
+
+
+def expansion(text, seed):
+    """Returns a context manager for one prompt expansion, which collects the stage breakdown for the slow prompt log"""
+    return Expansion(text, seed) if ENABLED else NOOP
+
+
+def observe(name, seconds):
+    with lock:
+        h = histograms.get(name)
+        if h is None:
+            h = histograms[name] = [[0] * (len(BUCKETS) + 1), 0.0]
+        h[0][bisect_left(BUCKETS, seconds)] += 1
+        h[1] += seconds
+    stages = getattr(local, "stages", None)
+    if stages is not None:
+        stages[name] = stages.get(name, 0) + seconds
+
+
+def count(name, n=1):
+    if not ENABLED:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+    counts = getattr(local, "counts", None)
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + n
+
+
+def costs(costs):
+    """Records the costs of one prompt expansion"""
+    if not ENABLED:
+        return
+    with lock:
+        for name, value in costs.items():
+            t = cost_totals.setdefault(name, [0, 0, 0])
+            t[0] += 1
+            t[1] += value
+            t[2] = max(t[2], value)
+        recent_costs.append({"time": time.time(), **costs})
+    log.debug("Prompt expansion costs: %s", costs)
+
+
+def snapshot():
+    with lock:
+        stages = {}
+        for name, (buckets, total) in histograms.items():
+            cumulative, n = {}, 0
+            for le, c in zip(BUCKETS + ("+Inf",), buckets):
+                n += c
+                cumulative[str(le)] = n
+            stages[name] = {"count": n, "sum": total, "buckets": cumulative}
+        return {
+            "enabled": ENABLED,
+            "stages": stages,
+            "counters": dict(counters),
+            "costs": {k: {"count": c, "sum": t, "max": m} for k, (c, t, m) in cost_totals.items()},
+            "recent_costs": list(recent_costs),
+            "slow_prompts": list(slow_prompts),
+        }
+
+
+def lru_caches(stats, prefix=""):
+    """Yields (name, stats) for each LRU cache in a nested dict of cache stats"""
+    for k, v in stats.items():
+        if isinstance(v, dict):
+            if "hits" in v:
+                yield prefix + k, v
+            else:
+                yield from lru_caches(v, prefix + k + " ")
+
+
+def prometheus(cache_stats):
+    """Returns the metrics in Prometheus text format"""
+    s = snapshot()
+    lines = [
+        "# HELP mu_wildcard_stage_seconds Time spent in each stage of prompt expansion",
+        "# TYPE mu_wildcard_stage_seconds histogram",
+    ]
+    for name, h in s["stages"].items():
+        for le, c in h["buckets"].items():
+            lines.append(f'mu_wildcard_stage_seconds_bucket{{stage="{name}",le="{le}"}} {c}')
+        lines.append(f'mu_wildcard_stage_seconds_sum{{stage="{name}"}} {h["sum"]}')
+        lines.append(f'mu_wildcard_stage_seconds_count{{stage="{name}"}} {h["count"]}')
+    lines += ["# HELP mu_wildcard_events_total Counted events", "# TYPE mu_wildcard_events_total counter"]
+    for name, c in s["counters"].items():
+        lines.append(f'mu_wildcard_events_total{{event="{name}"}} {c}')
+    lines += ["# HELP mu_wildcard_prompt_cost Costs of prompt expansions", "# TYPE mu_wildcard_prompt_cost summary"]
+    for name, c in s["costs"].items():
+        lines.append(f'mu_wildcard_prompt_cost_sum{{cost="{name}"}} {c["sum"]}')
+        lines.append(f'mu_wildcard_prompt_cost_count{{cost="{name}"}} {c["count"]}')
+    lines += [
+        "# HELP mu_wildcard_prompt_cost_max Largest cost of a prompt expansion",
+        "# TYPE mu_wildcard_prompt_cost_max gauge",
+    ]
+    lines += [f'mu_wildcard_prompt_cost_max{{cost="{name}"}} {c["max"]}' for name, c in s["costs"].items()]
+    caches = list(lru_caches(cache_stats))
+    for metric, key in [("hits", "hits"), ("misses", "misses")]:
+        lines += [f"# HELP mu_cache_{metric}_total Cache {metric}", f"# TYPE mu_cache_{metric}_total counter"]
+        lines += [f'mu_cache_{metric}_total{{cache="{name}"}} {v[key]}' for name, v in caches]
+    lines += ["# HELP mu_cache_size Approximate size of cache contents", "# TYPE mu_cache_size gauge"]
+    lines += [f'mu_cache_size{{cache="{name}"}} {v["size"]}' for name, v in caches]
+    return "\n".join(lines) + "\n"
+
+
+def add_routes(server, cache_stats):
+    """Adds /mu_utils/metrics (JSON) and /mu_utils/metrics/prometheus to the ComfyUI server"""
+    if not hasattr(server, "routes"):
+        return
+    from aiohttp import web
+
+    @server.routes.get("/mu_utils/metrics")
+    async def metrics_json(request):
+        return web.json_response({**snapshot(), "caches": cache_stats()})
+
+    @server.routes.get("/mu_utils/metrics/prometheus")
+    async def metrics_prometheus(request):
+        return web.Response(
+            body=prometheus(cache_stats()).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
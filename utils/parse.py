@@ -1,5 +1,9 @@
 import lark
 import logging
+import re
+import sys
+from functools import lru_cache
+from os import environ
 
 logging.basicConfig(level=logging.DEBUG)
 from lark.visitors import Interpreter, v_args
@@ -47,10 +51,32 @@ SINGLES.-10: /[,;]/
 from collections import ChainMap
 
 from .jinja_render import render_jinja
+from .cache import LRUCache
+from . import budget
+from . import compiler
+from . import fastparse
+from . import metrics
+from .budget import ExpansionLimitError
 from jinja2.exceptions import TemplateSyntaxError
 
+# "earley" uses the lark grammar above, "fast" the hand-written parser in fastparse.py
+PARSER = environ.get("MU_WILDCARD_PARSER", "earley")
+# "compiled" compiles parse trees into closures with compiler.py, "interpreter" walks them with TestVisitor
+ENGINE = environ.get("MU_WILDCARD_ENGINE", "compiled")
+# "lazy" evaluates a variable's definition every time it's used, "once" only the first time, and also reuses the
+# results of function calls with the same arguments
+EVAL_MODE = environ.get("MU_WILDCARD_EVAL", "lazy")
+# Jinja expressions matching this can give different results each time
+IMPURE_JINJA = re.compile(r"random|datetime|now")
+# Expand prompts a chunk at a time, reusing the results of chunks that haven't changed, see expand_chunks
+INCREMENTAL = environ.get("MU_WILDCARD_INCREMENTAL", "") not in ("", "0")
+# Function calls can nest this deep. With the interpreter, Python's recursion limit is reached a bit beyond that
+MAX_DEPTH = int(environ.get("MU_WILDCARD_MAX_DEPTH", 30))
+
 
 def eval(ctx, x):
+    if IMPURE_JINJA.search(x):
+        ctx.impure()
     try:
         return render_jinja(f"<={x}=>")
     except TemplateSyntaxError as e:
@@ -59,7 +85,7 @@ def eval(ctx, x):
 
 
 def const(x):
-    def f():
+    def f(vm=None):
         return x
 
     return f
@@ -68,6 +94,9 @@ def const(x):
 class Context:
     def __init__(self):
         self.vars = ChainMap()
+        self.visitor = None
+        # False once something has been evaluated that can give a different result each time
+        self.pure = True
 
     def __enter__(self):
         self.vars = self.vars.new_child()
@@ -77,11 +106,24 @@ class Context:
         self.vars = self.vars.parents
         return False
 
+    def child(self):
+        """Returns a new context layered over this one. Definitions made in it don't change this context,
+        so several children of one context can be used from different threads"""
+        c = Context()
+        c.vars = self.vars.new_child()
+        return c
+
     def set(self, name, value):
-        self.vars[str(name)] = value
+        self.vars[name] = value
 
     def get(self, name, default=None):
-        return self.vars.get(str(name), default)
+        return self.vars.get(name, default)
+
+    def impure(self):
+        """Marks the expansion, and the function calls being evaluated, as not reusable"""
+        self.pure = False
+        if self.visitor:
+            self.visitor.impure()
 
 
 def varname(x):
@@ -101,6 +143,8 @@ def flatten(seq):
 
 
 def prompt(seq):
+    if isinstance(seq, str):
+        return seq
     return "".join(flatten(seq))
 
 
@@ -112,6 +156,8 @@ def showarg(a):
 
 
 def print_context_functions(ctx):
+    ctx.impure()
+
     def p(x):
         print("MUWildcard help:", x)
 
@@ -124,29 +170,84 @@ def print_context_functions(ctx):
 
 
 def debug(ctx, x):
+    ctx.impure()
     print("MUWildCard Debug:", x)
 
 
 MAGIC_FUNCTIONS = {"$": eval, "help": print_context_functions, "debug": debug}
 
 
+class CallFrame:
+    """A function call being evaluated in "once" mode. Records the names the call looked up from outside itself,
+    which its result depends on"""
+
+    __slots__ = ("depth", "deps", "impure")
+
+    def __init__(self, depth):
+        # Position of the call's scope in the context's ChainMap, counting from the outermost one
+        self.depth = depth
+        self.deps = {}
+        self.impure = False
+
+
 class TestVisitor(Interpreter):
-    def __init__(self, ctx=None):
+    def __init__(self, ctx=None, mode=None):
         super().__init__()
         self.ctx = ctx or Context()
+        self.ctx.visitor = self
+        once = (mode or EVAL_MODE) == "once"
+        # Evaluate variables only once, and reuse results of function calls
+        self.once_vars = self.memoize = once
+        # (function, arguments) -> (function, dependencies, result)
+        self.memo = {}
+        # Variable definition -> (dependencies, value), in "once" mode
+        self.values = {}
+        self.frames = []
+        self.depth = 0
+
+    def lookup(self, name):
+        v = self.ctx.get(name)
+        if self.frames:
+            maps = self.ctx.vars.maps
+            depth = -1
+            for i, m in enumerate(maps):
+                if name in m:
+                    depth = len(maps) - 1 - i
+                    break
+            for f in reversed(self.frames):
+                if depth >= f.depth:
+                    break
+                f.deps.setdefault(name, v)
+        return v
+
+    def impure(self):
+        for f in self.frames:
+            f.impure = True
 
     def __default__(self, tree):
         return self.visit_children(tree)
 
+    def evaluate(self, node):
+        """Expands a parse tree, or code compiled from one"""
+        if isinstance(node, lark.Tree):
+            return self.visit(node)
+        return compiler.text(self, node)
+
     @v_args(inline=True)
     def function_definition(self, var, argspec, function_body):
-        var = varname(var)
-        args = self.visit_children(argspec)
+        self.visit_children(argspec)
+        params = [(varname(arg.children[0]), arg.children[1]) for arg in argspec.children]
+        self.define_function(varname(var), params, function_body)
+        return ""
+
+    def define_function(self, var, params, body):
+        """Defines $var. params is [(name, default)], the defaults and body being parse trees or compiled code"""
+        budget.charge("steps")
         found_defval = None
         args = []
         with self.ctx as c:
-            for arg in argspec.children:
-                x, defval = self.visit(arg)
+            for x, default in params:
+                defval = prompt(self.evaluate(default)).strip() if default else None
                 if found_defval and not defval:
                     raise TypeError(f"Invalid function definition for {var}, must define default for {x}")
                 found_defval = defval
@@ -154,10 +255,7 @@ class TestVisitor(Interpreter):
                 # Allow $fn($a=1, $b=$a)
                 if x not in c.vars:
                     c.set(x, defval)
-        with self.ctx as locals:
-            res = (locals, args, function_body)
-        self.ctx.set(var, res)
-        return ""
+        self.ctx.set(var, (self.ctx, args, body))
 
     @v_args(inline=True)
     def argument(self, var, defval):
@@ -188,70 +286,147 @@ class TestVisitor(Interpreter):
 
     @v_args(inline=True)
     def quoted(self, value):
-        value = value.replace('\\"', '"')
-        if value == '""':
-            return '"'
-        return value[1:][:-1]
+        return compiler.unquote(value)
 
     @v_args(inline=True)
     def function_call(self, var, arglist):
-        var = varname(var)
         positional, named = self.visit(arglist)
+        return self.call(varname(var), positional, named)
 
+    def call(self, var, positional, named):
+        metrics.count("function_calls")
+        budget.charge("steps")
         if var in MAGIC_FUNCTIONS:
-            return MAGIC_FUNCTIONS[var](self.ctx, *positional, **named)
-
+            result = MAGIC_FUNCTIONS[var](self.ctx, *positional, **named)
+            budget.charge("text_chars", len(result or ""))
+            return result
+
+        fn = self.lookup(var)
+        if self.memoize:
+            key = (id(fn), tuple(positional), tuple(sorted(named.items())))
+            hit = self.memo.get(key)
+            if hit and hit[0] is fn and all(self.ctx.get(n) is v for n, v in hit[1].items()):
+                metrics.count("function_calls_reused")
+                # The reused result depends on the same names as the call that computed it
+                for n in hit[1]:
+                    self.lookup(n)
+                return hit[2]
         try:
-            locals, params, function_body = self.ctx.get(var)
+            _, params, function_body = fn
         except TypeError:
             print_context_functions(self.ctx)
             raise TypeError(f"${var} is not a function")
-        with self.ctx as c:
-            if len(positional) > len(params):
-                raise TypeError(f"Invalid number of arguments to function ${var}({','.join(f'${a}' for a in params)})")
-
-            # Fill in with defaults
-            positional = positional + [p[1] for p in params][len(positional) :]
-
-            for k, v in locals.vars.items():
-                c.set(k, v)
-
-            set_args = {}
-
-            for a, v in zip(params, positional):
-                set_args[a[0]] = v
-
-            for k, v in named.items():
-                set_args[k] = v
-
-            for p in params:
-                if p[0] not in set_args or set_args[p[0]] is None:
-                    raise TypeError(
-                        f"Missing argument ${p[0]} to function ${var}({','.join(showarg(a) for a in params)})"
-                    )
-                c.set(p[0], const(set_args[p[0]]))
-
-            return prompt(self.visit(function_body)).strip()
+        if len(positional) > len(params):
+            raise TypeError(f"Invalid number of arguments to function ${var}({','.join(f'${a}' for a in params)})")
+        budget.charge("function_calls", where=f", at ${var}")
+        if self.depth >= MAX_DEPTH:
+            raise ExpansionLimitError(
+                f"Function calls nested more than {MAX_DEPTH} deep (MU_WILDCARD_MAX_DEPTH), at ${var}"
+            )
+
+        # Fill in with defaults
+        positional = positional + [p[1] for p in params][len(positional) :]
+
+        set_args = {}
+
+        for a, v in zip(params, positional):
+            set_args[a[0]] = v
+
+        for k, v in named.items():
+            set_args[k] = v
+
+        frame = {}
+        for p in params:
+            if p[0] not in set_args or set_args[p[0]] is None:
+                raise TypeError(f"Missing argument ${p[0]} to function ${var}({','.join(showarg(a) for a in params)})")
+            frame[p[0]] = const(set_args[p[0]])
+
+        # The call sees its arguments and local definitions, then the caller's variables, which include the preamble's
+        # under the prompt's. The scopes are linked, not copied
+        caller = self.ctx.vars
+        self.ctx.vars = ChainMap(frame, *caller.maps)
+        self.depth += 1
+        try:
+            if not self.memoize:
+                result = prompt(self.evaluate(function_body)).strip()
+                budget.charge("text_chars", len(result), f", at ${var}")
+                return result
+            call = CallFrame(len(self.ctx.vars.maps) - 1)
+            self.frames.append(call)
+            try:
+                result = prompt(self.evaluate(function_body)).strip()
+            finally:
+                self.frames.pop()
+            budget.charge("text_chars", len(result), f", at ${var}")
+            if not call.impure:
+                self.memo[key] = (fn, call.deps, result)
+            return result
+        except RecursionError:
+            raise ExpansionLimitError(
+                f"Function calls nested too deeply for Python's recursion limit, at ${var}"
+            ) from None
+        finally:
+            self.depth -= 1
+            self.ctx.vars = caller
 
     @v_args(inline=True)
     def var(self, name):
-        v = self.ctx.get(name)
+        v = self.value(name.value)
+        budget.charge("text_chars", len(prompt(v)), f", at ${name}")
+        return v
+
+    def value(self, name):
+        budget.charge("steps")
+        v = self.lookup(name)
         if isinstance(v, tuple):
             raise TypeError(f"${name} is a function, can't use as a variable")
-        if v:
-            return v()
-        else:
+        if not v:
             raise TypeError(f"${name} is undefined")
+        try:
+            return v(self)
+        except RecursionError:
+            raise ExpansionLimitError(f"Variables nested too deeply for Python's recursion limit, at ${name}") from None
+
+    def var_text(self, name):
+        text = prompt(self.value(name))
+        budget.charge("text_chars", len(text), f", at ${name}")
+        return text
 
     @v_args(inline=True)
     def var_definition(self, var, definition=""):
-        name = var.children[0].value
-
-        if definition:
+        self.define_var(var.children[0].value, definition)
+        return ""
 
-            def resolve():
-                with self.ctx as c:
-                    v = self.visit(definition)
+    def define_var(self, name, definition):
+        """Defines $name, evaluated when it's used. definition is a parse tree, compiled code or empty.
+
+        The definition is evaluated by the visitor using it, in its context, so that definitions in the preamble see
+        the prompt's variables and the preamble's context is never changed by expanding prompts"""
+        budget.charge("steps")
+        if definition and self.once_vars:
+
+            def resolve(vm):
+                hit = vm.values.get(resolve)
+                if hit and all(vm.ctx.get(n) is v for n, v in hit[0].items()):
+                    # The reused value depends on the same names as the evaluation that computed it
+                    for n in hit[0]:
+                        vm.lookup(n)
+                    return hit[1]
+                with vm.ctx:
+                    frame = CallFrame(len(vm.ctx.vars.maps) - 1)
+                    vm.frames.append(frame)
+                    try:
+                        value = vm.evaluate(definition)
+                    finally:
+                        vm.frames.pop()
+                vm.values[resolve] = (frame.deps, value)
+                return value
+
+        elif definition:
+
+            def resolve(vm):
+                with vm.ctx as c:
+                    v = vm.evaluate(definition)
                     c.set(name, const(v))
                     return v
 
@@ -259,7 +434,6 @@ class TestVisitor(Interpreter):
             resolve = const("")
 
         self.ctx.set(name, resolve)
-        return ""
 
     def start(self, tree):
         result = self.visit_children(tree)
@@ -267,20 +441,219 @@ class TestVisitor(Interpreter):
         return final_prompt, self.ctx
 
 
-parser = lark.Lark(definition, parser="earley")
+@lru_cache(maxsize=None)
+def earley_parser():
+    return lark.Lark(definition, parser="earley")
 
 
-def parse(x, ctx=None):
+def parse_tree(x, mode=None):
+    mode = mode or PARSER
+    if mode == "fast":
+        return intern_names(fastparse.parse(x))
+    elif mode == "earley":
+        return intern_names(earley_parser().parse(x))
+    raise ValueError(f"Unknown parser {mode}, expected 'earley' or 'fast'")
+
+
+def intern_names(tree):
+    """Interns variable and function names in tree, so that looking them up compares them by identity"""
+    for t in tree.iter_subtrees():
+        if t.data == "var" and t.children:
+            t.children[0].value = sys.intern(t.children[0].value)
+    return tree
+
+
+# Parse trees keyed on prompt text, sized by text length
+TREE_CACHE = LRUCache("trees", int(environ.get("MU_WILDCARD_CACHE_SIZE", 10_000_000)), lambda k, v: len(k))
+
+
+def cached_parse_tree(x):
+    tree = TREE_CACHE.get(x)
+    if tree is None:
+        tree = parse_tree(x)
+        TREE_CACHE.put(x, tree)
+    return tree
+
+
+# Compiled parse trees keyed on prompt text
+PROGRAM_CACHE = LRUCache("programs", int(environ.get("MU_WILDCARD_CACHE_SIZE", 10_000_000)), lambda k, v: len(k))
+
+
+def cached_program(x):
+    code = PROGRAM_CACHE.get(x)
+    if code is None:
+        code = compiler.compile_tree(cached_parse_tree(x))
+        PROGRAM_CACHE.put(x, code)
+    return code
+
+
+def run(code, ctx=None):
+    """Runs compiled code, returning (text, context) like TestVisitor.visit"""
+    vm = TestVisitor(ctx)
+    return compiler.text(vm, code), vm.ctx
+
+
+def execute(tree, ctx=None, engine=None):
+    """Expands a parse tree with the given engine, returning (text, context)"""
+    engine = engine or ENGINE
+    with budget.expansion():
+        if engine == "compiled":
+            return run(compiler.compile_tree(tree), ctx)
+        elif engine == "interpreter":
+            return TestVisitor(ctx).visit(tree)
+    raise ValueError(f"Unknown engine {engine}, expected 'compiled' or 'interpreter'")
+
+
+# Splits prompts into chunks after runs of newlines outside of brackets and quoted strings
+CHUNK_RE = re.compile(r'"(?:[^"\\\n]|\\.)*"|[(){}]|(?:\r?\n)+')
+
+
+def split_chunks(x):
+    """Splits x after each run of newlines that isn't inside brackets. Definitions and expressions can't span such a
+    newline, so the chunks parse the same way on their own as they do as part of x. A definition ends with the whole
+    run, so it can't be split inside one"""
+    chunks = []
+    depth = start = 0
+    for m in CHUNK_RE.finditer(x):
+        c = m.group()
+        if c in "({":
+            depth += 1
+        elif c in ")}":
+            depth -= 1
+        elif c[-1] == "\n" and depth == 0:
+            chunks.append(x[start : m.end()])
+            start = m.end()
+    if start < len(x):
+        chunks.append(x[start:])
+    return chunks
+
+
+DEFINITIONS = ("var_definition", "function_definition")
+# Results kept for each chunk, eg. for expansions with different seeds
+CHUNK_RESULTS = 4
+
+
+class Chunk:
+    """Compiled code for a chunk of a prompt and for just its definitions, the names it defines and its most recent
+    results"""
+
+    __slots__ = ("code", "definitions", "names", "results")
+
+    def __init__(self, tree):
+        defs = [t for t in tree.children if isinstance(t, lark.Tree) and t.data in DEFINITIONS]
+        self.code = compiler.compile_tree(tree)
+        self.definitions = compiler.compile_tree(lark.Tree("start", defs))
+        self.names = {varname(t.children[0]) for t in defs}
+        # (ChunkResult, ...), newest first
+        self.results = ()
+
+    def result(self, version):
+        """Returns a result whose dependencies have the same versions now, or None"""
+        for result in self.results:
+            if all(version(n) == v for n, v in result.deps.items()):
+                return result
+        return None
+
+
+class ChunkResult:
+    __slots__ = ("deps", "text")
+
+    def __init__(self, deps, text):
+        # name -> version of the name when the chunk was expanded
+        self.deps = deps
+        self.text = text
+
+
+# Chunks keyed on their text
+CHUNK_CACHE = LRUCache("chunks", int(environ.get("MU_WILDCARD_CACHE_SIZE", 10_000_000)), lambda k, v: len(k))
+
+
+def cached_chunk(x):
+    chunk = CHUNK_CACHE.get(x)
+    if chunk is None:
+        chunk = Chunk(parse_tree(x))
+        CHUNK_CACHE.put(x, chunk)
+    return chunk
+
+
+def expand_chunks(x, ctx, versions):
+    """Expands x a chunk at a time with compiled code. A chunk whose text is unchanged and whose dependencies have the
+    same versions as when it was last expanded only runs its definitions, and its previous text is reused.
+
+    Names defined by chunks are versioned by the ChunkResult of the chunk that defined them, so a chunk that is
+    expanded again gives new versions to its definitions and the chunks using them are expanded again too. Other
+    names are versioned by versions, or by their value in ctx"""
+    with metrics.stage("parse"):
+        chunks = [cached_chunk(c) for c in split_chunks(x)]
+    with metrics.stage("expand"):
+        vm = TestVisitor(ctx)
+        ctx = vm.ctx
+        versions = {**ctx.vars.maps[0], **versions}
+        base = ChainMap(*ctx.vars.maps[1:])
+
+        def version(name):
+            return versions[name] if name in versions else base.get(name)
+
+        out = []
+        for chunk in chunks:
+            # In "once" mode, a variable's value depends on where it's first used, which may be in another chunk
+            result = None if vm.once_vars else chunk.result(version)
+            if result:
+                metrics.count("chunks_reused")
+                chunk.definitions(vm, out)
+                out.append(result.text)
+            else:
+                metrics.count("chunks_expanded")
+                # Records the names the chunk reads from outside of function calls
+                frame = CallFrame(len(ctx.vars.maps))
+                vm.frames.append(frame)
+                start = len(out)
+                try:
+                    chunk.code(vm, out)
+                finally:
+                    vm.frames.pop()
+                result = ChunkResult({n: version(n) for n in frame.deps}, "".join(out[start:]))
+                if not frame.impure and not vm.once_vars:
+                    chunk.results = (result,) + chunk.results[: CHUNK_RESULTS - 1]
+            for n in chunk.names:
+                versions[n] = result
+        return "".join(out), ctx
+
+
+def parse(x, ctx=None, variables=None):
+    """Expands x, returning (text, context), or (x, None) if it fails. variables are strings set in the context
+    before expanding, eg. the seed. Raises ExpansionLimitError if the expansion goes over its budget"""
     try:
-        r = TestVisitor(ctx).visit(parser.parse(x))
+        with budget.expansion():
+            r = expand_text(x, ctx or Context(), variables or {})
         if r is None:
             return x, None
         return r
+    except ExpansionLimitError:
+        raise
     except Exception as e:
         log.error("Parse error: %s", e)
         return x, None
 
 
+def expand_text(x, ctx, variables):
+    versions = {}
+    for k, v in variables.items():
+        ctx.set(k, const(v))
+        versions[k] = ("value", v)
+    if INCREMENTAL:
+        return expand_chunks(x, ctx, versions)
+    if ENGINE == "compiled":
+        with metrics.stage("parse"):
+            code = cached_program(x)
+        with metrics.stage("expand"):
+            return run(code, ctx)
+    with metrics.stage("parse"):
+        tree = cached_parse_tree(x)
+    with metrics.stage("expand"):
+        return TestVisitor(ctx).visit(tree)
+
+
 def debug_parse(text, p="earley", **kwargs):
     x = lark.Lark(definition, parser=p, debug=True)
     return x.parse(text)
@@ -288,3 +661,29 @@ def debug_parse(text, p="earley", **kwargs):
 
 def pparse(text, p="earley", **kwargs):
     print(debug_parse(text, p, **kwargs).pretty())
+
+
+def check_parity(text, ctx_factory=Context):
+    """Expands text with both parsers and returns the results if they differ, otherwise None"""
+    results = []
+    for mode in ("earley", "fast"):
+        try:
+            results.append(TestVisitor(ctx_factory()).visit(parse_tree(text, mode))[0])
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    if results[0] != results[1]:
+        return tuple(results)
+    return None
+
+
+def check_engines(text, ctx_factory=Context):
+    """Expands text with the compiled code and the interpreter and returns the results if they differ, otherwise None"""
+    results = []
+    for engine in ("compiled", "interpreter"):
+        try:
+            results.append(execute(parse_tree(text), ctx_factory(), engine)[0])
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    if results[0] != results[1]:
+        return tuple(results)
+    return None
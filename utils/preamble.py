@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from os import environ
+from pathlib import Path
+
+import lark
+
+from . import parse as p
+from .cache import CACHE_DIR
+
+log = logging.getLogger("comfyui-misc-utils")
+
+SNAPSHOT_VERSION = 1
+
+# file -> (snapshot key, parse tree)
+trees = {}
+# (context, generation). Replaced as a whole so that readers always see a consistent pair
+state = None
+lock = threading.Lock()
+
+
+def include_files():
+    includes = environ.get("MU_WILDCARD_INCLUDE", "defaults")
+    files = []
+    for x in includes.split(";"):
+        x = x.strip()
+        if x == "defaults":
+            files.append(Path(__file__).parent / "default_functions.txt")
+        elif x:
+            files.append(Path(x))
+    return files
+
+
+def snapshot_key(file):
+    st = file.stat()
+    return (SNAPSHOT_VERSION, lark.__version__, p.PARSER, str(file.resolve()), st.st_size, st.st_mtime_ns)
+
+
+def snapshot_path(file):
+    return CACHE_DIR / f"preamble-{hashlib.sha1(str(file.resolve()).encode()).hexdigest()}.pickle"
+
+
+def load_snapshot(file, key):
+    try:
+        with open(snapshot_path(file), "rb") as f:
+            k, tree = pickle.load(f)
+        if k == key:
+            return tree
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("Ignoring unreadable preamble snapshot for %s: %s", file, e)
+    return None
+
+
+def save_snapshot(file, key, tree):
+    path = snapshot_path(file)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "wb") as f:
+            pickle.dump((key, tree), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as e:
+        log.warning("Could not save preamble snapshot for %s: %s", file, e)
+        tmp.unlink(missing_ok=True)
+
+
+def file_key(file):
+    try:
+        return snapshot_key(file)
+    except OSError:
+        return None
+
+
+def load_tree(file):
+    """Returns the parse tree for file, parsing it only if it has changed since it was last seen.
+    Returns None if the file can't be read or parsed"""
+    key = file_key(file)
+    cached = trees.get(file)
+    if cached and cached[0] == key:
+        return cached[1]
+    tree = None
+    if key is None:
+        log.error("Preamble file %s not found. Ignoring...", file)
+    else:
+        tree = load_snapshot(file, key)
+        if tree is None:
+            try:
+                log.info("Reading functions from %s", file)
+                with open(file, "r") as f:
+                    tree = p.parse_tree(f.read())
+                save_snapshot(file, key, tree)
+            except Exception as e:
+                log.error("Error reading definitions from %s: %s. Ignoring...", file, e)
+    trees[file] = (key, tree)
+    return tree
+
+
+def read_preamble(engine=None):
+    ctx = p.Context()
+    for file in include_files():
+        tree = load_tree(file)
+        if tree is None:
+            continue
+        try:
+            p.execute(tree, ctx, engine)
+        except Exception as e:
+            log.error("Error evaluating definitions from %s: %s. Ignoring...", file, e)
+    return ctx
+
+
+def get_preamble(reload=False):
+    """Returns (context, generation). The generation changes whenever the context is reloaded"""
+    global state
+    with lock:
+        if state is None or reload:
+            state = (read_preamble(), state[1] + 1 if state else 1)
+        return state
+
+
+def changed_files():
+    return [f for f in include_files() if f not in trees or trees[f][0] != file_key(f)]
+
+
+def watch(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            changed = changed_files()
+            if changed and state is not None:
+                log.info("Reloading wildcard preamble, changed: %s", ", ".join(str(f) for f in changed))
+                get_preamble(reload=True)
+        except Exception as e:
+            log.error("Preamble watcher failed: %s", e)
+
+
+def start_watcher():
+    """Reloads the preamble in the background when an include file changes if MU_WILDCARD_WATCH is set
+    to a polling interval in seconds"""
+    interval = float(environ.get("MU_WILDCARD_WATCH", 0))
+    if interval > 0:
+        threading.Thread(target=watch, args=(interval,), daemon=True, name="MUWildcardWatcher").start()
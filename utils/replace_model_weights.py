@@ -1,37 +1,249 @@
+import logging
+import time
+import weakref
+
+import torch
 import folder_paths
 import comfy.utils
 from comfy.sd import CLIP
 
+from . import checkpoint_cache
+from .fingerprints import FingerprintCache
+from .safetensors_file import SafetensorsFile
+
+log = logging.getLogger("comfyui-misc-utils")
+
+UNET_PREFIX = "model.diffusion_model."
+# Checkpoint weights that are neither the UNet nor CLIP
+VAE_PREFIX = "first_stage_model."
+
+FINGERPRINTS = FingerprintCache()
+# module -> {key: fingerprint} of the weights copied into it by stream_weights
+LOADED = weakref.WeakKeyDictionary()
+# model config class -> CLIP whose weights are replaced in place, with clip_mode "reuse"
+CLIPS = {}
+
+
+def load_clip(model_config, sd, clip=None):
+    """Returns a new CLIP with the CLIP weights in the checkpoint state dict sd, or loads them into clip"""
+    clip_sd = model_config.process_clip_state_dict(sd)
+    if clip is None:
+        clip = CLIP(model_config.clip_target(), embedding_directory=folder_paths.get_folder_paths("embeddings"))
+    LOADED.pop(clip.cond_stage_model, None)
+    clip.load_sd(clip_sd, full_model=True)
+    return clip
+
+
+def load_unet_weights(diffusion_model, model_config, sd):
+    """Loads the UNet weights in the checkpoint state dict sd into diffusion_model, removing them from sd"""
+    to_load = {}
+    for k in list(sd.keys()):
+        if k.startswith(UNET_PREFIX):
+            to_load[k[len(UNET_PREFIX) :]] = sd.pop(k)
+    to_load = model_config.process_unet_state_dict(to_load)
+    LOADED.pop(diffusion_model, None)
+    diffusion_model.load_state_dict(to_load, strict=False)
+
+
+class Key:
+    """Stands in for a tensor when working out where a state dict processing function moves it. Anything but moving
+    it, like slicing or transposing, raises an exception"""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+
+def key_map(process, sd):
+    """Returns {model key: checkpoint key}, given process, a state dict processing function, and sd, {key it expects:
+    checkpoint key}. Returns None if process does more than rename keys, eg. splits tensors"""
+    try:
+        processed = process({k: Key(v) for k, v in sd.items()})
+    except Exception:
+        return None
+    values = list(processed.values())
+    if not all(isinstance(v, Key) for v in values) or len({id(v) for v in values}) != len(values):
+        return None
+    return {k: v.key for k, v in processed.items()}
+
+
+def unet_key_map(model_config, keys):
+    return key_map(
+        model_config.process_unet_state_dict, {k[len(UNET_PREFIX) :]: k for k in keys if k.startswith(UNET_PREFIX)}
+    )
+
+
+def clip_keys(keys):
+    """Returns the keys of a checkpoint that aren't UNet or VAE weights"""
+    return [k for k in keys if not k.startswith((UNET_PREFIX, VAE_PREFIX))]
+
+
+def stream_unet_weights(diffusion_model, model_config, f, fingerprints=None):
+    """Streams the UNet weights in the SafetensorsFile f into diffusion_model, see stream_weights. Returns None
+    without changing anything if the model's state dict processing does more than rename keys"""
+    keys = unet_key_map(model_config, f.keys())
+    return None if keys is None else stream_weights(diffusion_model, keys, f, fingerprints)
+
+
+def stream_clip_weights(clip, model_config, f, fingerprints=None):
+    """Streams the CLIP weights in the SafetensorsFile f into clip, like stream_unet_weights"""
+    keys = key_map(model_config.process_clip_state_dict, {k: k for k in clip_keys(f.keys())})
+    return None if keys is None else stream_weights(clip.cond_stage_model, keys, f, fingerprints)
+
+
+def stream_weights(module, key_map, f, fingerprints=None):
+    """Copies the weights in the SafetensorsFile f into module in place, one tensor at a time, so that at most one
+    tensor is in memory at once. key_map is {module key: checkpoint key}. Like load_state_dict(strict=False), weights
+    the module doesn't have are ignored.
+
+    fingerprints maps checkpoint keys to fingerprints of their tensors. If given, weights whose fingerprint is that
+    of the weight already copied into the model by an earlier call are skipped, and the fingerprints that are missing
+    are computed and added to it.
+
+    Returns (copied, skipped, skipped bytes)"""
+    targets = module.state_dict(keep_vars=True)
+    to_copy = [(k, targets[k], ckpt_key) for k, ckpt_key in key_map.items() if k in targets]
+    # Checked up front, so that a checkpoint for another model type doesn't leave the model half replaced
+    for _, target, ckpt_key in to_copy:
+        if target.shape != f.shape(ckpt_key):
+            raise RuntimeError(
+                f"size mismatch for {ckpt_key}: shape {tuple(f.shape(ckpt_key))} in the checkpoint, "
+                f"{tuple(target.shape)} in the current model"
+            )
+    # Forgotten until the copy is done, in case it fails halfway
+    loaded = LOADED.pop(module, {})
+    copied = skipped = skipped_bytes = 0
+    with torch.no_grad():
+        for k, target, ckpt_key in to_copy:
+            if fingerprints is not None:
+                fingerprint = fingerprints.get(ckpt_key)
+                if fingerprint is None:
+                    fingerprint = fingerprints[ckpt_key] = f.fingerprint(ckpt_key)
+                if loaded.get(k) == fingerprint:
+                    skipped += 1
+                    skipped_bytes += f.nbytes(ckpt_key)
+                    f.release(ckpt_key)
+                    continue
+                loaded[k] = fingerprint
+            else:
+                loaded.pop(k, None)
+            target.copy_(f.view(ckpt_key))
+            f.release(ckpt_key)
+            copied += 1
+    LOADED[module] = loaded
+    return copied, skipped, skipped_bytes
+
+
+def log_counts(part, counts):
+    copied, skipped, skipped_bytes = counts
+    log.info(
+        "Copied %s %s weights, skipped %s (%.1f MiB) that were already loaded",
+        copied,
+        part,
+        skipped,
+        skipped_bytes / 2**20,
+    )
+
+
+def replace_clip(model_config, f, fingerprints, clip=None):
+    """Returns a new CLIP with the CLIP weights in the SafetensorsFile f, or streams them into clip"""
+    if clip is not None:
+        counts = stream_clip_weights(clip, model_config, f, fingerprints)
+        if counts is not None:
+            log_counts("CLIP", counts)
+            return clip
+    return load_clip(model_config, {k: f.tensor(k) for k in clip_keys(f.keys())}, clip)
+
+
+def replace_unet(diffusion_model, model_config, f, fingerprints):
+    counts = stream_unet_weights(diffusion_model, model_config, f, fingerprints)
+    if counts is None:
+        log.info("Can't stream weights for %s, loading them all at once", type(model_config).__name__)
+        unet_keys = [k for k in f.keys() if k.startswith(UNET_PREFIX)]
+        load_unet_weights(diffusion_model, model_config, {k: f.tensor(k) for k in unet_keys})
+    else:
+        log_counts("UNet", counts)
+
 
 class MUReplaceModelWeights:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": {"model": ("MODEL",), "ckpt_name": (folder_paths.get_filename_list("checkpoints"),)}}
+        return {
+            "required": {"model": ("MODEL",), "ckpt_name": (folder_paths.get_filename_list("checkpoints"),)},
+            "optional": {"clip_mode": (["new", "reuse", "skip"], {"default": "new"})},
+        }
 
     RETURN_TYPES = ("MODEL", "CLIP")
     FUNCTION = "do"
 
     CATEGORY = "utils"
 
-    def do(self, model, ckpt_name):
+    def do(self, model, ckpt_name, clip_mode="new"):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        sd = comfy.utils.load_torch_file(ckpt_path, safe_load=True)
-        to_load = {}
         model = model.clone()
-        # Reload clip
-        clip_target = model.model.model_config.clip_target()
-        clip_sd = model.model.model_config.process_clip_state_dict(sd)
-        clip = CLIP(clip_target, embedding_directory=folder_paths.get_folder_paths("embeddings"))
-        clip.load_sd(clip_sd, full_model=True)
-        del clip_sd
-
-        pfx = "model.diffusion_model."
-        for k in list(sd.keys()):
-            if k.startswith(pfx):
-                to_load[k[len(pfx) :]] = sd.pop(k)
+        model_config = model.model.model_config
+        diffusion_model = model.model.diffusion_model
         print("Replacing weights with", ckpt_path)
-        to_load = model.model.model_config.process_unet_state_dict(to_load)
-        model.model.diffusion_model.load_state_dict(to_load, strict=False)
-        del to_load
-
+        # "reuse" loads the weights into the CLIP returned for this model type before, if there is one
+        clip = CLIPS.get(type(model_config)) if clip_mode == "reuse" else None
+        times = [time.perf_counter()]
+        cached = checkpoint_cache.get(ckpt_path)
+        if not ckpt_path.lower().endswith(".safetensors"):
+            # The cached state dict is shared, and loading removes weights from it
+            sd = dict(cached) if cached is not None else comfy.utils.load_torch_file(ckpt_path, safe_load=True)
+            times.append(time.perf_counter())
+            if clip_mode != "skip":
+                clip = load_clip(model_config, sd, clip)
+            times.append(time.perf_counter())
+            load_unet_weights(diffusion_model, model_config, sd)
+            times.append(time.perf_counter())
+        else:
+            # Reads only the weights that are needed, and copies them straight from the file
+            stat_key, fingerprints = FINGERPRINTS.get(ckpt_path)
+            with SafetensorsFile(ckpt_path, cached) as f:
+                times.append(time.perf_counter())
+                if clip_mode != "skip":
+                    clip = replace_clip(model_config, f, fingerprints, clip)
+                times.append(time.perf_counter())
+                replace_unet(diffusion_model, model_config, f, fingerprints)
+                times.append(time.perf_counter())
+            FINGERPRINTS.put(ckpt_path, stat_key, fingerprints)
+        if clip_mode == "reuse":
+            CLIPS[type(model_config)] = clip
+        elif clip_mode == "skip":
+            clip = None
+        read, clip_time, unet = (b - a for a, b in zip(times, times[1:]))
+        log.info(
+            "Replaced weights with %s in %.2fs: reading %.2fs, UNet %.2fs, CLIP %.2fs (%s)",
+            ckpt_name,
+            times[-1] - times[0],
+            read,
+            unet,
+            clip_time,
+            clip_mode,
+        )
         return (model, clip)
+
+
+def prefetch_handler(json_data):
+    """Starts reading the checkpoints of the MUReplaceModelWeights nodes in a queued prompt into memory"""
+    try:
+        for n in json_data["prompt"].values():
+            name = n["inputs"].get("ckpt_name")
+            # Inputs connected to another node are lists
+            if n["class_type"] == "MUReplaceModelWeights" and isinstance(name, str):
+                path = folder_paths.get_full_path("checkpoints", name)
+                if path:
+                    checkpoint_cache.prefetch(path)
+    except Exception as e:
+        log.error("Could not prefetch checkpoints: %s", e)
+    return json_data
+
+
+try:
+    from server import PromptServer
+
+    PromptServer.instance.add_on_prompt_handler(prefetch_handler)
+except ImportError:
+    pass
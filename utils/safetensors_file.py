@@ -0,0 +1,100 @@
+"""Reads tensors from a .safetensors file one at a time through a memory map, without loading the whole file.
+
+The file can also be read from a copy of its contents in memory.
+
+The format is an 8 byte little-endian header length, a JSON header mapping tensor names to their dtype, shape and
+byte offsets in the data that follows, and the data."""
+
+import hashlib
+import json
+import mmap
+
+import torch
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    DTYPES.update({"F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2})
+ITEMSIZES = {dtype: torch.empty(0, dtype=dtype).element_size() for dtype in DTYPES.values()}
+
+
+class SafetensorsFile:
+    def __init__(self, path, contents=None):
+        """contents is a bytearray with the contents of the file, which is then not read"""
+        self.path = path
+        self.mapped = contents is None
+        if self.mapped:
+            with open(path, "rb") as f:
+                # A private mapping is writable as far as torch.frombuffer is concerned, but nothing is written to it
+                self.buf = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_COPY)
+        else:
+            self.buf = contents
+        n = int.from_bytes(self.buf[:8], "little")
+        self.header = json.loads(self.buf[8 : 8 + n])
+        self.header.pop("__metadata__", None)
+        self.data_start = 8 + n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.mapped:
+            self.buf.close()
+
+    def keys(self):
+        return self.header.keys()
+
+    def shape(self, key):
+        return torch.Size(self.header[key]["shape"])
+
+    def view(self, key):
+        """Returns the tensor key without copying it. It's only valid until the file is closed"""
+        info = self.header[key]
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            return torch.empty(info["shape"], dtype=dtype)
+        t = torch.frombuffer(
+            self.buf, dtype=dtype, count=(end - begin) // ITEMSIZES[dtype], offset=self.data_start + begin
+        )
+        return t.reshape(info["shape"])
+
+    def tensor(self, key):
+        """Returns a copy of the tensor key"""
+        return self.view(key).clone()
+
+    def nbytes(self, key):
+        begin, end = self.header[key]["data_offsets"]
+        return end - begin
+
+    def fingerprint(self, key):
+        """Returns a hash of the dtype, shape and data of the tensor key"""
+        info = self.header[key]
+        begin, end = info["data_offsets"]
+        h = hashlib.sha256(f"{info['dtype']}{info['shape']}".encode())
+        with memoryview(self.buf) as m:
+            h.update(m[self.data_start + begin : self.data_start + end])
+        return h.hexdigest()[:32]
+
+    def release(self, key):
+        """Drops the pages of the tensor key from memory once it has been used. They're read again if needed"""
+        if not self.mapped or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        begin, end = self.header[key]["data_offsets"]
+        start = (self.data_start + begin) // mmap.PAGESIZE * mmap.PAGESIZE
+        length = self.data_start + end - start
+        if length > 0:
+            self.buf.madvise(mmap.MADV_DONTNEED, start, length)
@@ -0,0 +1,234 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from os import environ
+from pathlib import Path
+
+from .cache import LRUCache
+from . import budget
+from . import metrics
+
+log = logging.getLogger("comfyui-misc-utils")
+
+
+def parse_name(name):
+    """Splits name:filter:!filter into the name and a tuple of filters"""
+    r = name.split(":")
+    return r[0], tuple(r[1:])
+
+
+def matches(x, filters):
+    for f in filters:
+        if f.startswith("!") and f[1:] in x:
+            return False
+        elif not f.startswith("!") and f not in x:
+            return False
+    return True
+
+
+def stat_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+INDEX_MAGIC = b"MUWCIDX1"
+INDEX_HEADER = struct.Struct("<8s2sQQQ")
+
+
+class LargeWildcardFile:
+    """A memory-mapped wildcard file with an index of line offsets.
+
+    Behaves like a sequence of the stripped, non-empty lines of the file, but only decodes lines when they're
+    accessed. The index is saved next to the file as name.txt.idx"""
+
+    def __init__(self, path, st):
+        self.path = Path(path)
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
+        self.offsets = self.load_index(st)
+        if self.offsets is None:
+            self.offsets = self.build_index()
+            self.save_index(st)
+
+    def index_path(self):
+        return self.path.with_name(self.path.name + ".idx")
+
+    def header(self, st):
+        return (INDEX_MAGIC, self.typecode().encode() + b"\0", st.st_size, st.st_mtime_ns, len(self.buf))
+
+    def typecode(self):
+        return "I" if len(self.buf) < 2**32 else "Q"
+
+    def load_index(self, st):
+        try:
+            with open(self.index_path(), "rb") as f:
+                header = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if header != self.header(st):
+                    return None
+                offsets = array(self.typecode())
+                offsets.frombytes(f.read())
+                return offsets
+        except (OSError, struct.error):
+            return None
+
+    def save_index(self, st):
+        path = self.index_path()
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(INDEX_HEADER.pack(*self.header(st)))
+                self.offsets.tofile(f)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("Could not save wildcard index for %s: %s", self.path, e)
+
+    def build_index(self):
+        log.info("Indexing large wildcard file %s", self.path)
+        offsets = array(self.typecode())
+        buf = self.buf
+        start = 0
+        end = len(buf)
+        while start < end:
+            nl = buf.find(b"\n", start)
+            if nl < 0:
+                nl = end
+            if buf[start:nl].strip():
+                offsets.append(start)
+            start = nl + 1
+        return offsets
+
+    def line_end(self, start):
+        end = self.buf.find(b"\n", start)
+        return len(self.buf) if end < 0 else end
+
+    def raw_line(self, start):
+        return self.buf[start : self.line_end(start)]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.raw_line(self.offsets[i]).decode("utf-8", errors="replace").strip()
+
+    def containing(self, term):
+        """Yields the offsets of lines containing term, in order"""
+        for m in re.finditer(rb"^[^\n]*?" + re.escape(term), self.buf, re.M):
+            yield m.start()
+
+    def filter(self, filters):
+        """Returns a view of the lines matching filters. Uses substring search on the mapped file so that
+        only lines that contain the first term that isn't negated need to be looked at"""
+        positive = [f.encode() for f in filters if not f.startswith("!")]
+        negative = [f[1:].encode() for f in filters if f.startswith("!")]
+        candidates = self.containing(positive[0]) if positive else self.offsets
+        # The other terms are checked on each candidate line, so memory use doesn't grow with the lines excluded
+        checks = [(f, True) for f in positive[1:]] + [(f, False) for f in negative]
+        buf = self.buf
+
+        def keep(start):
+            end = buf.find(b"\n", start)
+            line = buf[start:end] if end >= 0 else buf[start:]
+            for f, wanted in checks:
+                if (f in line) != wanted:
+                    return False
+            return True
+
+        return LargeWildcardView(self, array(self.offsets.typecode, filter(keep, candidates)))
+
+
+class LargeWildcardView:
+    def __init__(self, file, offsets):
+        self.file = file
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.file.raw_line(self.offsets[i]).decode("utf-8", errors="replace").strip()
+
+
+class WildcardIndex:
+    """Keeps the lines of wildcard files in memory, revalidating them with stat on each lookup,
+    and memoizes filtered views of them"""
+
+    def __init__(self, filtered_size=int(environ.get("MU_WILDCARD_CACHE_SIZE", 10_000_000))):
+        # path -> (stat key, lines)
+        self.files = {}
+        # (path, stat key, filters) -> lines
+        self.filtered = LRUCache("wildcard filters", filtered_size, lambda k, v: len(v) + 1)
+        self.lock = threading.Lock()
+        # Files at least this large are memory-mapped and indexed instead of read into memory
+        self.large_file_size = int(environ.get("MU_WILDCARD_LARGE_FILE_SIZE", 64 * 1024 * 1024))
+
+    def basedir(self):
+        return Path(environ.get("MU_WILDCARD_BASEDIR", "wildcards"))
+
+    def path(self, name):
+        return (self.basedir() / Path(name)).with_suffix(".txt")
+
+    def load(self, path, st):
+        metrics.count("wildcard_files_read")
+        if st.st_size >= self.large_file_size:
+            metrics.count("wildcard_files_mapped")
+            return LargeWildcardFile(path, st)
+        budget.charge("wildcard_bytes", st.st_size, f", reading {path}")
+        metrics.count("wildcard_bytes_read", st.st_size)
+        with open(path, "r") as file:
+            return tuple(x for x in (line.strip() for line in file) if x)
+
+    def lines(self, path):
+        """Returns (stat key, lines) for path, reading it only if it has changed"""
+        st = os.stat(path)
+        key = stat_key(st)
+        cached = self.files.get(path)
+        if cached and cached[0] == key:
+            return cached
+        with self.lock:
+            cached = self.files.get(path)
+            if not cached or cached[0] != key:
+                cached = (key, self.load(path, st))
+                self.files[path] = cached
+            return cached
+
+    def version(self, name):
+        """Returns the stat key of the wildcard file name, or None if it doesn't exist"""
+        try:
+            return stat_key(os.stat(self.path(name)))
+        except OSError:
+            return None
+
+    def lookup(self, name, filters=()):
+        """Returns the lines of a wildcard file matching filters, or None if the file doesn't exist"""
+        path = self.path(name)
+        try:
+            key, lines = self.lines(path)
+        except OSError:
+            return None
+        if not filters:
+            return lines
+        fkey = (path, key, filters)
+        result = self.filtered.get(fkey)
+        if result is None:
+            if isinstance(lines, LargeWildcardFile):
+                budget.charge("wildcard_bytes", len(lines.buf), f", filtering {path}")
+                result = lines.filter(filters)
+            else:
+                result = tuple(x for x in lines if matches(x, filters))
+            self.filtered.put(fkey, result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.filtered.clear()
+
+    def stats(self):
+        return {
+            "files": len(self.files),
+            "lines": sum(len(v[1]) for v in self.files.values()),
+            "filtered": self.filtered.stats(),
+        }
@@ -1,12 +1,22 @@
+import hashlib
+from functools import partial
+from itertools import repeat
 import logging
+import multiprocessing
 from os import environ
 import random
 import re
-from pathlib import Path
-import json
-import mmap
-
-from .parse import parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .parse import parse, TREE_CACHE, PROGRAM_CACHE, CHUNK_CACHE
+from .cache import LRUCache
+from .jinja_render import TEMPLATE_CACHE
+from . import budget
+from . import metrics
+from .budget import ExpansionLimitError
+from .preamble import get_preamble, read_preamble, start_watcher, changed_files
+from .lora_tags import LoraTagCache, start_indexer
+from .wildcard_files import WildcardIndex, parse_name, matches as matches_filters
 
 # from .parse import parse
 
@@ -16,46 +26,21 @@ log.setLevel(logging.INFO)
 CLASS_NAME = "MUSimpleWildcard"
 
 
+LORA_TAGS = LoraTagCache()
+
+
 def get_lora_tags(lora_name):
-    filenames = [Path(f) for f in folder_paths.get_filename_list("loras")]
-    found = None
-    for f in filenames:
-        if f.stem == lora_name:
-            found = folder_paths.get_full_path("loras", str(f))
-            break
-    if not found:
-        return []
-    meta = load_lora_meta(found)
-    tags = json.loads(meta.get("ss_tag_frequency", "{}"))
-    alltags = []
-    tagcounts = {}
-    for k in tags:
-        for tag, count in tags[k].items():
-            t = tag.strip().replace("_", " ")
-            tagcounts[t] = tagcounts.get(t, 0) + count
-    alltags = [(v, k) for k, v in tagcounts.items()]
-    return sorted(alltags, reverse=True)
-
-
-def load_lora_meta(filename):
-    try:
-        with open(filename, "r", encoding="utf8") as f:
-            with mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ) as m:
-                header = m.read(8)
-                n = int.from_bytes(header, "little")
-                metadata_bytes = m.read(n)
-                return json.loads(metadata_bytes).get("__metadata__", {})
-    except Exception as e:
-        log.error("Metadata load failed for %s: %s", filename, e)
-        return {}
-
-
-def replace_lora_tags(text, seed):
+    return LORA_TAGS.lora_tags(lora_name)
+
+
+LORA_TAG_RE = re.compile(r"\bTAG<(?P<args>.*?)>")
+
+
+def replace_lora_tags(text, seed, sources=None):
     rand = random.Random(seed)
-    func = re.compile(r"\bTAG<(?P<args>.*?)>")
-    matches, text = find_and_remove(func, text, placeholder="WILDCARDLORA")
-    for placeholder, value in matches.items():
-        args = value["args"].strip().split(",")
+
+    def replace(m):
+        args = m["args"].strip().split(",")
         replacement = []
         count = 1
         mode = "t"
@@ -65,6 +50,7 @@ def replace_lora_tags(text, seed):
                 count = int(args[1])
             if len(args) > 2:
                 mode = args[2].strip()
+            record_source(sources, ("lora_tags", loraname))
             tags = [t[1] for t in get_lora_tags(loraname)]
             if len(tags) <= count:
                 replacement = tags
@@ -77,37 +63,115 @@ def replace_lora_tags(text, seed):
             print("Error selecting tags:", e)
             pass
 
-        r = ", ".join(replacement)
-        text = text.replace(placeholder, r)
+        return ", ".join(replacement)
+
+    return LORA_TAG_RE.sub(replace, text)
+
+
+# (expansion, sources) keyed on (text, seed, preamble generation), sized by text length. The expansion is reused while
+# the versions of its sources are unchanged
+EXPANSION_CACHE = LRUCache(
+    "expansions", int(environ.get("MU_WILDCARD_CACHE_SIZE", 10_000_000)), lambda k, v: len(k[0]) + len(v[0])
+)
+
+
+def source_version(source):
+    """Returns the version of something an expansion read: the stat key of a ("wildcard", name) file, the path and
+    stat key of a ("lora_tags", name) LoRA, or the list of LoRAs for ("loras", None)"""
+    kind, name = source
+    if kind == "wildcard":
+        return WILDCARDS.version(name)
+    elif kind == "lora_tags":
+        return LORA_TAGS.version(name)
+    return tuple(folder_paths.get_filename_list("loras"))
+
+
+def record_source(sources, source):
+    """Records the version of source in sources, a dict, before it's read"""
+    if sources is not None and source not in sources:
+        sources[source] = source_version(source)
+
+
+def sources_unchanged(sources):
+    return all(source_version(s) == v for s, v in sources.items())
+
 
-    return text
+def cache_stats():
+    stats = {c.name: c.stats() for c in (TREE_CACHE, PROGRAM_CACHE, CHUNK_CACHE, EXPANSION_CACHE, TEMPLATE_CACHE)}
+    stats["wildcards"] = WILDCARDS.stats()
+    stats["lora tags"] = LORA_TAGS.stats()
+    return stats
 
 
-global_ctx = None
+# Expansions of different nodes in a prompt run on a pool of this many workers, "thread" or "process". The process
+# pool forks, so it's only available on platforms that support it
+WORKERS = int(environ.get("MU_WILDCARD_WORKERS", 4))
+POOL = environ.get("MU_WILDCARD_POOL", "thread")
+executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        if POOL == "process":
+            executor = fork_pool(WORKERS)
+        else:
+            executor = ThreadPoolExecutor(WORKERS, thread_name_prefix="MUWildcard")
+    return executor
 
 
 def wildcard_prompt_handler(json_data):
-    for node_id in json_data["prompt"].keys():
-        if json_data["prompt"][node_id]["class_type"] == CLASS_NAME:
-            handle_wildcard_node(json_data, node_id)
+    wildcard_info = json_data.get("extra_data", {}).get("extra_pnginfo", {}).get(CLASS_NAME, {})
+    # node id -> cache key, in prompt order
+    nodes = {}
+    results = {}
+    # cache key -> (preamble, reload) for expansions that aren't cached
+    pending = {}
+    for node_id, n in json_data["prompt"].items():
+        if n["class_type"] != CLASS_NAME or (n["inputs"].get("use_pnginfo") and node_id in wildcard_info):
+            continue
+        text, seed = n["inputs"]["text"], n["inputs"]["seed"]
+        reload = "$debugwc" in text
+        # The generation changes when the preamble is reloaded, so cached expansions using the old one are not reused
+        ctx, generation = get_preamble(reload=reload)
+        key = (text, seed, generation)
+        nodes[node_id] = key
+        if key in results or key in pending:
+            continue
+        cached = EXPANSION_CACHE.get(key)
+        if cached is None or not sources_unchanged(cached[1]):
+            pending[key] = (ctx, reload)
+        else:
+            results[key] = cached[0]
+
+    if len(pending) > 1 and WORKERS > 1:
+        pool = get_executor()
+        futures = {}
+        for key, (ctx, reload) in pending.items():
+            if isinstance(pool, ProcessPoolExecutor):
+                futures[key] = pool.submit(expand_in_worker, key[0], key[1], reload)
+            else:
+                futures[key] = pool.submit(try_expand, key[0], key[1], ctx)
+        for key, f in futures.items():
+            results[key] = f.result()
+    else:
+        for key, (ctx, _) in pending.items():
+            results[key] = try_expand(key[0], key[1], ctx)
+    for key in pending:
+        text, cacheable, sources = results[key]
+        results[key] = text
+        if cacheable:
+            EXPANSION_CACHE.put(key, (text, sources))
+
+    # Results are applied in prompt order regardless of the order they finished in
+    for node_id, key in nodes.items():
+        handle_wildcard_node(json_data, node_id, results[key])
     return json_data
 
 
-def handle_wildcard_node(json_data, node_id):
-    global global_ctx
+def handle_wildcard_node(json_data, node_id, text):
     wildcard_info = json_data.get("extra_data", {}).get("extra_pnginfo", {}).get(CLASS_NAME, {})
     n = json_data["prompt"][node_id]
-    seed = n["inputs"]["seed"]
-    if not (n["inputs"].get("use_pnginfo") and node_id in wildcard_info):
-        RAND.seed(seed)
-        text, delayed = replace_wildcards(n["inputs"]["text"])
-        if not global_ctx or "$debugwc" in text:
-            global_ctx = read_preamble()
-        global_ctx.set("seed", lambda: str(seed))
-        text, _ = parse(text, global_ctx)
-        text, _ = replace_wildcards(text, delayed)
-        text = replace_lora_tags(text, seed)
-
     if text.strip() != n["inputs"]["text"].strip():
         json_data["prompt"][node_id]["inputs"]["use_pnginfo"] = True
         wildcard_info[node_id] = text
@@ -115,110 +179,163 @@ def handle_wildcard_node(json_data, node_id):
     return json_data
 
 
-def read_preamble():
-    includes = environ.get("MU_WILDCARD_INCLUDE", "defaults")
-    includes = [x.strip() for x in includes.split(";") if x.strip()]
-    ctx = None
-    for x in includes:
-        file = Path(x)
-        if x == "defaults":
-            curfile = Path(__file__)
-            file = curfile.parent / "default_functions.txt"
-        try:
-            with open(file, "r") as f:
-                log.info("Reading functions from %s", file)
-                ctx = parse(f.read(), ctx=ctx)[1]
-        except Exception as e:
-            log.error("Error reading definitions from %s: %s. Ignoring...", file, e)
-    return ctx
+def expand_in_worker(text, seed, reload):
+    # Worker processes keep their own copy of the preamble, reloaded when the main process would reload it
+    ctx, _ = get_preamble(reload=reload or bool(changed_files()))
+    return try_expand(text, seed, ctx)
 
 
-def find_and_remove(regexp, text, placeholder=""):
-    m = regexp.search(text)
-    res = {}
-    index = 0
+def fork_pool(processes):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return ThreadPoolExecutor(processes, thread_name_prefix="MUWildcard")
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("fork"))
 
-    while m:
-        index += 1
-        ph = ""
-        if placeholder:
-            ph = "__" + placeholder + str(index) + "__"
-            res[ph] = m.groupdict()
-        else:
-            res[m["name"]] = m.groupdict()
-        s, e = m.span()
-        text = text[:s] + ph + text[e:]
-        m = regexp.search(text)
-    return res, text
+
+def expand_batch(text, seeds, processes=0):
+    """Yields (seed, expansion) for each seed, in order, sharing the preamble, wildcard files and parse trees
+    between them. Parsing is only done once if the template has no wildcards that are selected before
+    macro expansion, ie. it only uses $?name$. With processes > 1, seeds are split across forked processes"""
+    seeds = list(seeds)
+    ctx, _ = get_preamble()
+    if processes > 1:
+        with fork_pool(processes) as pool:
+            chunksize = max(1, min(256, len(seeds) // (processes * 4)))
+            results = pool.map(partial(expand_in_worker, text), seeds, repeat(False), chunksize=chunksize)
+            yield from zip(seeds, (r[0] for r in results))
+    else:
+        for seed in seeds:
+            yield seed, expand(text, seed, ctx)
 
 
-RAND = random.Random()
+def expand(text, seed, preamble):
+    """Returns the expansion of text, or text itself if the expansion goes over its budget"""
+    return try_expand(text, seed, preamble)[0]
 
 
-def read_wildcards(name):
-    path = environ.get("MU_WILDCARD_BASEDIR", "wildcards")
-    r = name.split(":")
-    name = r[0]
-    filters = r[1:]
+def try_expand(text, seed, preamble):
+    """Returns (expansion of text, cacheable, sources). sources maps the wildcard files and LoRAs the expansion read
+    to their versions, see source_version.
 
-    def matches(x):
-        for f in filters:
-            if f.startswith("!") and f[1:] in x:
-                return False
-            elif not f.startswith("!") and f not in x:
-                return False
-        return True
+    The expansion isn't cacheable if it's impure, eg. it uses Jinja's random or $debug(), or if it went over its
+    budget, in which case text itself is returned. An aborted expansion may succeed next time, eg. if it ran out of
+    time or read a wildcard file for the first time"""
+    sources = {}
+    with metrics.expansion(text, seed), budget.expansion() as b:
+        try:
+            rng = WildcardRNG(seed)
+            with metrics.stage("wildcards"):
+                expanded, delayed = replace_wildcards(text, rng, sources=sources)
+            # Definitions in the prompt go in a child context so that they don't leak into other prompts
+            expanded, ctx = parse(expanded, preamble.child(), {"seed": str(seed)})
+            with metrics.stage("wildcards"):
+                expanded, _ = replace_wildcards(expanded, rng, delayed, sources)
+            with metrics.stage("lora_tags"):
+                expanded = replace_lora_tags(expanded, seed, sources)
+            return expanded, ctx is None or ctx.pure, sources
+        except ExpansionLimitError as e:
+            log.error("MUSimpleWildcard expansion aborted: %s. Costs so far: %s", e, b.costs)
+            return text, False, sources
+
+
+# "hashed" derives each selection from the seed, the wildcard and its position, "legacy" draws all selections
+# from a single random sequence like older versions did, which reproduces their results for a given seed
+RNG_MODE = environ.get("MU_WILDCARD_RNG", "hashed")
+
+
+class WildcardRNG:
+    """Selects wildcard values for one expansion"""
+
+    def __init__(self, seed, mode=None):
+        self.seed = seed
+        self.mode = mode or RNG_MODE
+        self.rand = random.Random(seed)
+        # (name, offset) -> number of selections so far
+        self.occurrences = {}
+
+    def choice(self, name, offset, ws):
+        if self.mode == "legacy":
+            return self.sequential_choice(offset, ws)
+        occurrence = self.occurrences.get((name, offset), 0)
+        self.occurrences[(name, offset)] = occurrence + 1
+        h = hashlib.blake2b(f"{self.seed}\0{name}\0{occurrence}\0{offset}".encode(), digest_size=8)
+        return ws[int.from_bytes(h.digest(), "little") % len(ws)]
+
+    def sequential_choice(self, offset, ws):
+        if not offset:
+            return self.rand.choice(ws)
+        # advance the state once and store it so that the next non-offset result stays deterministic
+        w = self.rand.choice(ws)
+        state = self.rand.getstate()
+        # advance the state until offset,
+        for _ in range(offset):
+            w = self.rand.choice(ws)
+        self.rand.setstate(state)
+        return w
+
+
+WILDCARDS = WildcardIndex()
+
+
+def read_wildcards(name, sources=None):
+    name, filters = parse_name(name)
 
     if name == "LORA":
-        return [l for l in folder_paths.get_filename_list("loras") if matches(l)]
+        record_source(sources, ("loras", None))
+        return [l for l in folder_paths.get_filename_list("loras") if matches_filters(l, filters)]
 
-    f = (Path(path) / Path(name)).with_suffix(".txt")
-    try:
-        with open(f, "r") as file:
-            return [l.strip() for l in file.readlines() if l.strip() and matches(l)]
-    except:
+    record_source(sources, ("wildcard", name))
+    ws = WILDCARDS.lookup(name, filters)
+    if ws is None:
         log.warning("Wildcard file not found for %s", name)
         return [name]
-
-
-def replace_wildcards(text, delayed_matches=None):
-    if delayed_matches is not None:
-        # replace delayed match placeholders with names again to properly select them
-        for ph, v in delayed_matches.items():
-            offset = v["offset"] or 0
-            name = v["name"]
-            text = text.replace(ph, f"${name}+{offset}$")
-    wildcard_re = re.compile(r"\$(?P<name>[A-Za-z0-9_/.!:?-]+)(\+(?P<offset>[0-9]+))?\$")
-    matches, text = find_and_remove(wildcard_re, text, placeholder="MU_WILDCARD")
-    delayed = {}
-    for placeholder, value in matches.items():
-        state = None
-        name = value["name"]
-        if name.startswith("?") and delayed_matches is None:
-            # Handle wildcard after macro expansion
-            value["name"] = name[1:]
-            delayed[placeholder] = value
-            continue
-        ws = read_wildcards(name)
-        offset = int(value["offset"] or 0)
-        if ws and offset:
-            # advance the state once and store it so that the next non-offset result stays deterministic
-            w = RAND.choice(ws)
-            state = RAND.getstate()
-            # advance the state until offset,
-            for _ in range(offset):
-                w = RAND.choice(ws)
-        elif ws:
-            w = RAND.choice(ws)
+    return ws
+
+
+# Delayed wildcards are carried through macro expansion as markers holding their index in the list of delayed
+# wildcards. Private use characters don't clash with prompt syntax or with text in wildcard files
+DELAYED_MARKER = "\ue000{}\ue001"
+WILDCARD_RE = re.compile(r"\ue000(?P<delayed>[0-9]+)\ue001|\$(?P<name>[A-Za-z0-9_/.!:?-]+)(\+(?P<offset>[0-9]+))?\$")
+
+
+def select_wildcard(name, offset, found, rng, sources=None):
+    if name not in found:
+        found[name] = read_wildcards(name, sources)
+    ws = found[name]
+    if ws:
+        w = rng.choice(name, offset, ws)
+        budget.charge("text_chars", len(w), f", at wildcard {name}")
+    else:
+        log.warning("No wildcards found for %s", name)
+        w = ""
+    log.info("Replaced wildcard %s with '%s'", name, w)
+    return w
+
+
+def replace_wildcards(text, rng, delayed_matches=None, sources=None):
+    """Selects all wildcards in text in a single left-to-right pass.
+
+    On the first pass (delayed_matches is None), $?name$ wildcards are replaced with markers and returned as a
+    list of (name, offset) so that they can be selected after macro expansion by passing the list back in. The
+    wildcard files read are recorded in sources, see record_source"""
+    delayed = []
+    # Each distinct wildcard is only looked up once per prompt
+    found = {}
+
+    def replace(m):
+        if m["delayed"] is not None:
+            i = int(m["delayed"])
+            if delayed_matches is None or i >= len(delayed_matches):
+                return m[0]
+            name, offset = delayed_matches[i]
         else:
-            log.warning("No wildcards found for %s", value["name"])
-            w = ""
-        text = text.replace(placeholder, w)
-        log.info("Replaced wildcard %s with '%s'", value["name"], w)
-        if state:
-            RAND.setstate(state)
+            name, offset = m["name"], int(m["offset"] or 0)
+            if name.startswith("?") and delayed_matches is None:
+                # Handle wildcard after macro expansion
+                delayed.append((name[1:], offset))
+                return DELAYED_MARKER.format(len(delayed) - 1)
+        return select_wildcard(name, offset, found, rng, sources)
 
-    return text.strip(), delayed
+    return WILDCARD_RE.sub(replace, text).strip(), delayed
 
 
 class MUSimpleWildcard:
@@ -253,6 +370,9 @@ try:
     import folder_paths
 
     PromptServer.instance.add_on_prompt_handler(wildcard_prompt_handler)
+    start_watcher()
+    start_indexer(LORA_TAGS)
+    metrics.add_routes(PromptServer.instance, cache_stats)
 except ImportError:
     print("Could not install wildcard prompt handler, node won't work")
 